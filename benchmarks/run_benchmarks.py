@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the threethings model and webhook hot paths.
+
+Generates a synthetic population of users spread over many timezones and
+months of status updates, then times reminder planning, summary rendering,
+webhook ingest and reply parsing. Each result records wall time, SQL
+statement count and peak python memory, and is written as JSON so runs can
+be compared.
+
+    python benchmarks/run_benchmarks.py --users 2000 --weeks 26 \\
+        --output bench.json
+
+Without --database-url a throwaway PostgreSQL is started with
+testing.postgresql. A database given with --database-url has all its tables
+dropped, so it must also be given --reset.
+"""
+import argparse
+import calendar
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import pytz
+import transaction
+
+from sqlalchemy import (
+    create_engine,
+    event,
+)
+from zope.sqlalchemy import (
+    mark_changed,
+)
+
+from threethings import replies
+from threethings.model import (
+    Base,
+    Session,
+    StatusUpdate,
+    User,
+    WeeklySummary,
+    week_bucket,
+)
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+UPDATE_TEXT = """Last week:
+* Shipped the thing
+* Reviewed the other thing
+* Fixed {n} bugs
+
+Next week:
+* More things
+
+On Fri, Feb 6, 2015 at 3:00 PM, 3things <status@example.com> wrote:
+> Please reply with your weekly status update!
+"""
+
+REPLY_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, 'tests', 'fixtures', 'replies')
+
+# Friday evening UTC, inside the reminder window for most timezones
+REFERENCE_TIME = pytz.UTC.localize(datetime.datetime(2015, 6, 5, 22, 0))
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def measure(name, counter, func, repeat=1):
+    """Run func repeat times, returning a result dict for the report. Peak
+    memory is taken from one more run, as tracing slows func down."""
+    gc.collect()
+    counter.count = 0
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+    result = {
+        'name': name,
+        'repeat': repeat,
+        'seconds_min': min(timings),
+        'seconds_mean': sum(timings) / len(timings),
+        'queries': counter.count // repeat,
+        'peak_memory_bytes': None,
+    }
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    print("{name}: {seconds_min:.4f}s, {queries} queries".format(**result))
+    return result
+
+
+def populate(users, weeks, updates_per_week, seed):
+    rng = random.Random(seed)
+    zones = pytz.common_timezones
+    user_rows = [{
+        'email_address': 'user{}@example.com'.format(i),
+        'full_name': 'User {}'.format(i),
+        'timezone': rng.choice(zones),
+        'notifications_on': rng.random() > 0.05,
+    } for i in range(users)]
+    with transaction.manager:
+        Session.execute(User.__table__.insert(), user_rows)
+        mark_changed(Session())
+        transaction.commit()
+
+    start = REFERENCE_TIME - datetime.timedelta(weeks=weeks)
+    for week in range(weeks):
+        rows = []
+        for user in user_rows:
+            for n in range(updates_per_week):
+                if rng.random() < 0.2:
+                    continue
+                when = start + datetime.timedelta(
+                    weeks=week, seconds=rng.randint(0, 7 * 24 * 3600)
+                )
+                text = UPDATE_TEXT.format(n=n)
+                rows.append({
+                    'email_address': user['email_address'],
+                    'raw_text': text,
+                    'reply_text': text.split('\nOn ')[0].strip(),
+                    'when': when,
+                    'week': week_bucket(when),
+                })
+        with transaction.manager:
+            Session.execute(StatusUpdate.__table__.insert(), rows)
+            mark_changed(Session())
+            transaction.commit()
+    return user_rows
+
+
+def mailgun_event(user, n):
+    headers = [['Message-Id', '<bench-{}@example.com>'.format(n)]]
+    return {
+        'timestamp': [str(calendar.timegm(REFERENCE_TIME.utctimetuple()))],
+        'sender': [user['email_address']],
+        'body-plain': [UPDATE_TEXT.format(n=n)],
+        'body-html': ['<p>{}</p>'.format(UPDATE_TEXT.format(n=n))],
+        'subject': ['Re: Status Reminder'],
+        'message-headers': [json.dumps(headers)],
+        'parsed_message_id': headers[0][1],
+    }
+
+
+def reply_corpus(thread_length):
+    """The reply fixtures, and a reply to a thread of thread_length
+    quoted emails"""
+    corpus = []
+    for name in sorted(os.listdir(REPLY_FIXTURES)):
+        with io.open(os.path.join(REPLY_FIXTURES, name), encoding='utf-8',
+                     newline='') as fixture:
+            corpus.append(fixture.read())
+    thread = UPDATE_TEXT.format(n=0)
+    for n in range(1, thread_length):
+        quoted = '\n'.join('> ' + line for line in thread.splitlines())
+        thread = (UPDATE_TEXT.format(n=n).split('\nOn ')[0] +
+                  '\n\nOn Fri, Feb 6, 2015 at 3:00 PM, User {} <user{}'
+                  '@example.com> wrote:\n'.format(n, n) + quoted + '\n')
+    corpus.append(thread)
+    return corpus
+
+
+def run(args):
+    if args.database_url:
+        database_url = args.database_url
+        postgres = None
+    else:
+        import testing.postgresql
+        postgres = testing.postgresql.Postgresql()
+        database_url = postgres.url()
+
+    engine = create_engine(database_url)
+    Session.configure(bind=engine)
+    Base.metadata.bind = engine
+    if args.reset:
+        Base.metadata.drop_all()
+    Base.metadata.create_all()
+    counter = QueryCounter(engine)
+
+    try:
+        started = time.time()
+        user_rows = populate(args.users, args.weeks,
+                             args.updates_per_week, args.seed)
+        print("Populated in {:.1f}s".format(time.time() - started))
+
+        results = []
+
+        def plan_reminders():
+            with transaction.manager:
+                list(User.to_notify(REFERENCE_TIME))
+                transaction.abort()
+        results.append(measure('reminder_planning', counter,
+                               plan_reminders, args.repeat))
+
+        def render_summary():
+            with transaction.manager:
+                WeeklySummary(REFERENCE_TIME).email_contents()
+                transaction.abort()
+        results.append(measure('summary_rendering', counter,
+                               render_summary, args.repeat))
+
+        from threethings.web.mailgun import process_inbound_email
+        events = [mailgun_event(user, n)
+                  for n, user in enumerate(user_rows[:args.ingest])]
+
+        def ingest():
+            for email_json in events:
+                with transaction.manager:
+                    list(process_inbound_email(email_json))
+                    transaction.abort()
+        results.append(measure('webhook_ingest', counter, ingest))
+        results[-1]['messages'] = len(events)
+
+        corpus = reply_corpus(args.thread_length)
+        for name, parser in sorted(replies.PARSERS.items()):
+            def parse_replies():
+                for text in corpus:
+                    parser(text)
+            results.append(measure('reply_parsing_' + name, counter,
+                                   parse_replies, args.repeat))
+            results[-1]['emails'] = len(corpus)
+    finally:
+        Session.remove()
+        engine.dispose()
+        if postgres is not None:
+            postgres.stop()
+
+    return {
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'parameters': {
+            'users': args.users,
+            'weeks': args.weeks,
+            'updates_per_week': args.updates_per_week,
+            'ingest': args.ingest,
+            'thread_length': args.thread_length,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database-url')
+    parser.add_argument('--reset', action='store_true',
+                        help="drop all tables of --database-url first")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--weeks', type=int, default=13)
+    parser.add_argument('--updates-per-week', type=int, default=2)
+    parser.add_argument('--ingest', type=int, default=200,
+                        help="webhook deliveries to time")
+    parser.add_argument('--thread-length', type=int, default=50,
+                        help="quoted emails in the long thread reply parsed")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=3)
+    parser.add_argument('--output', default='bench.json')
+    args = parser.parse_args(argv)
+    if args.database_url and not args.reset:
+        parser.error("--database-url is emptied and filled with synthetic "
+                     "data, pass --reset to confirm")
+
+    report = run(args)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, sort_keys=True, indent=4,
+                  separators=(',', ': '))
+    print("Wrote {}".format(args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,9 @@ requirements = [
     'argh',
     'mako',
     'mandrill',
-    'sqlalchemy',
+    'sqlalchemy >= 1.1',
+    'psycopg2 >= 2.7',
+    'email_reply_parser >= 0.5',
     'pytz',
     'zope.sqlalchemy',
     'transaction',
@@ -24,6 +26,7 @@ requirements = [
     'pyramid',
     'pyramid_tm',
     'pyramid_mailer',
+    'repoze.lru',
     'repoze.sendmail == 4.1',
 ]
 
@@ -48,6 +51,10 @@ setup(
                  'threethings'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard'],
+        'aio': ['aiohttp', 'asyncpg', 'aiosmtplib'],
+    },
     license="BSD",
     zip_safe=False,
     keywords='threethings',
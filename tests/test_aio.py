@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_aio
+----------------------------------
+
+Tests for `threethings.web.aio` module.
+"""
+
+import asyncio
+import json
+
+from nose.plugins.skip import SkipTest
+
+try:
+    from aiohttp import FormData
+    from aiohttp.test_utils import TestClient, TestServer
+    from threethings.web.aio import make_app
+except ImportError:  # pragma: no cover
+    make_app = None
+
+from threethings.model import (
+    Session,
+    Base,
+    User,
+    StatusUpdate,
+    OutboundEmail,
+)
+
+import transaction
+
+from nose.tools import *  # noqa
+import testing.postgresql
+
+postgres_instance = None
+
+
+def setup_module():
+    global postgres_instance
+    if make_app is None:
+        raise SkipTest("the aio extra is not installed")
+    from sqlalchemy import create_engine
+    postgres_instance = testing.postgresql.Postgresql()
+    engine = create_engine(postgres_instance.url())
+    Session.configure(bind=engine)
+    Base.metadata.create_all(engine)
+    with transaction.manager:
+        user = User()
+        user.email_address = "boston@example.com"
+        user.timezone = "US/Eastern"
+        Session.add(user)
+        transaction.commit()
+
+
+def teardown_module():
+    Session.remove()
+    postgres_instance.stop()
+
+
+def mailgun_form(**extra):
+    form = FormData()
+    fields = {
+        'timestamp': '1423260000',
+        'sender': 'boston@example.com',
+        'subject': u'Stätus',
+        'body-plain': 'Did some work\n\nOn Fri, Bob wrote:\n> Status?',
+        'message-headers': json.dumps([['Message-Id', '<1@example.com>']]),
+    }
+    fields.update(extra)
+    for name, value in fields.items():
+        form.add_field(name, value)
+    form.add_field('attachment-1', b'x' * 100000, filename='big.bin')
+    return form
+
+
+def test_stores_once_and_queues_confirmation():
+    settings = {
+        'database.url': postgres_instance.url(),
+        # Nothing listens, the confirmation is left for drain_outbox
+        'mail.port': '1',
+        'mailgun.max_body_size': '200000',
+    }
+
+    async def deliver():
+        async with TestClient(TestServer(make_app(settings))) as client:
+            head = await client.head('/mailgun/receive')
+            first = await client.post('/mailgun/receive', data=mailgun_form())
+            again = await client.post('/mailgun/receive', data=mailgun_form())
+            too_big = await client.post('/mailgun/receive',
+                                        data=b'x' * 300000)
+            unknown = await client.post('/mailgun/receive', data=mailgun_form(
+                sender='nobody@example.com',
+                **{'message-headers': json.dumps(
+                    [['Message-Id', '<2@example.com>']]
+                )}
+            ))
+            return (head.status, first.status, await first.json(),
+                    await again.json(), too_big.status,
+                    (unknown.status, await unknown.json()))
+
+    loop = asyncio.new_event_loop()
+    try:
+        head, status, first, again, too_big, unknown = (
+            loop.run_until_complete(deliver())
+        )
+    finally:
+        loop.close()
+    eq_((head, status, too_big), (200, 200, 406))
+    eq_(first, again)
+    eq_(unknown, (200, []))
+
+    with transaction.manager:
+        update = Session.query(StatusUpdate).one()
+        eq_(first, [update.__json__(None)])
+        eq_(update.text, "Did some work")
+        eq_(update.raw_text.splitlines()[0], "Did some work")
+        eq_(StatusUpdate.search("work").count(), 1)
+        outbound = Session.query(OutboundEmail).one()
+        eq_(outbound.subject, u"Re: Stätus")
+        eq_((outbound.sent, outbound.attempts), (None, 1))
+        ok_(outbound.last_error)
+        ok_(outbound.next_attempt > outbound.created)
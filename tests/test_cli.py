@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_cli
+----------------------------------
+
+Tests for `threethings.cli` module.
+"""
+
+import subprocess
+import sys
+
+from nose.tools import *  # noqa
+
+# Generous, the point is to catch sqlalchemy & co creeping back in
+IMPORT_BUDGET_SECONDS = 0.25
+
+HEAVY_MODULES = [
+    'sqlalchemy',
+    'mako',
+    'pyramid',
+    'pyramid_mailer',
+    'dateutil',
+    'transaction',
+    'zope.sqlalchemy',
+]
+
+CHECK_IMPORTS = """
+import sys
+import time
+started = time.time()
+import threethings.cli
+elapsed = time.time() - started
+threethings.cli.build_parser().format_help()
+print(elapsed)
+print(' '.join(sorted(m for m in {heavy!r} if m in sys.modules)))
+"""
+
+
+def run_python(source):
+    output = subprocess.check_output([sys.executable, '-c', source])
+    return output.decode('utf-8').splitlines()
+
+
+def test_cli_import_and_help_skip_heavy_modules():
+    elapsed, loaded = (run_python(CHECK_IMPORTS.format(heavy=HEAVY_MODULES)) +
+                       [''])[:2]
+    eq_(loaded, '')
+    ok_(float(elapsed) < IMPORT_BUDGET_SECONDS,
+        "import took {}s".format(elapsed))
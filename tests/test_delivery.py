@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_delivery
+----------------------------------
+
+Tests for `threethings.delivery` module.
+"""
+
+import smtplib
+
+from pyramid_mailer.message import (
+    Message,
+)
+
+from threethings.delivery import (
+    PooledDelivery,
+)
+
+from nose.tools import *  # noqa
+
+
+class FakeSMTP(object):
+    connections = []
+
+    def __init__(self, host, port, timeout=None):
+        self.sent = []
+        self.closed = False
+        self.connections.append(self)
+
+    def sendmail(self, sender, recipients, body):
+        if 'refused@example.com' in recipients:
+            raise smtplib.SMTPRecipientsRefused({})
+        self.sent.extend(recipients)
+
+    def quit(self):
+        self.closed = True
+
+    close = quit
+
+
+def message_for(address):
+    return Message(subject="Hi", sender="robot@example.com",
+                   recipients=[address], body="Hello")
+
+
+def test_pooled_delivery_reuses_connections():
+    FakeSMTP.connections = []
+    delivery = PooledDelivery(workers=2, connection_factory=FakeSMTP)
+    addresses = ["user{}@example.com".format(i) for i in range(20)]
+    jobs = [(address, message_for(address)) for address in addresses]
+
+    results = list(delivery.send_all(jobs))
+
+    eq_(sorted(r.key for r in results if r.accepted), sorted(addresses))
+    ok_(len(FakeSMTP.connections) <= 2)
+    eq_(sorted(sum([c.sent for c in FakeSMTP.connections], [])),
+        sorted(addresses))
+    ok_(all(c.closed for c in FakeSMTP.connections))
+
+
+def test_pooled_delivery_reports_failures():
+    FakeSMTP.connections = []
+    delivery = PooledDelivery(workers=1, connection_factory=FakeSMTP)
+    jobs = [(address, message_for(address))
+            for address in ["ok@example.com", "refused@example.com"]]
+
+    results = {r.key: r for r in delivery.send_all(jobs)}
+
+    ok_(results["ok@example.com"].accepted)
+    ok_(not results["refused@example.com"].accepted)
+    eq_(len(FakeSMTP.connections), 1)
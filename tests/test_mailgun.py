@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_mailgun
+----------------------------------
+
+Tests for `threethings.web.mailgun` module.
+"""
+
+import json
+
+from pyramid.request import (
+    Request,
+)
+
+from threethings.web.mailgun import (
+    parse_mailgun_event,
+    receive_email,
+)
+
+from nose.tools import *  # noqa
+
+
+class FakeRegistry(object):
+    max_body_size = 1000
+    inbound_spool = None
+
+
+def mailgun_request(**extra):
+    params = {
+        'timestamp': '1423260000',
+        'sender': 'boston@example.com',
+        'subject': u'Stätus',
+        'body-plain': 'Did some work',
+        'body-html': '<p>Did some work</p>',
+        'message-headers': json.dumps([['Message-Id', '<1@example.com>']]),
+    }
+    params.update(extra)
+    return Request.blank('/mailgun/receive', POST=params)
+
+
+def test_parse_reads_only_event_fields():
+    request = mailgun_request(**{
+        'attachment-1': ('big.bin', b'x' * 100000),
+    })
+    event = parse_mailgun_event(request)
+    eq_(sorted(event), ['body-plain', 'message-headers', 'parsed_message_id',
+                        'sender', 'subject', 'timestamp'])
+    eq_(event['subject'], [u'Stätus'])
+    eq_(event['parsed_message_id'], '<1@example.com>')
+
+
+def test_receive_rejects_oversized_body():
+    request = mailgun_request(**{'body-plain': 'x' * 2000})
+    request.registry = FakeRegistry()
+    eq_(receive_email(request).status_code, 406)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `threethings.metrics` module.
+"""
+
+import time
+
+import transaction
+
+from pyramid_mailer.mailer import (
+    Mailer,
+)
+from pyramid_mailer.message import (
+    Message,
+)
+from sqlalchemy import create_engine
+
+from threethings.metrics import (
+    Metrics,
+    instrument_engine,
+    instrument_mailer,
+    scope,
+)
+
+from nose.tools import *  # noqa
+
+
+def run_queries(engine, count):
+    for i in range(count):
+        engine.execute("SELECT 1")
+
+
+def test_statements_are_counted_by_call_site_and_scope():
+    metrics = Metrics()
+    engine = instrument_engine(create_engine('sqlite://'), metrics)
+
+    with scope('send-reminders', metrics):
+        run_queries(engine, 3)
+
+    text = metrics.render()
+    ok_('threethings_sql_statement_seconds_count{'
+        'call_site="unknown",'
+        'scope="send-reminders"} 3' in text)
+    ok_('threethings_scope_sql_statements_sum{scope="send-reminders"} 3'
+        in text)
+
+
+class SlowSMTPMailer(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, fromaddr, toaddrs, message):
+        time.sleep(0.05)
+        self.sent.extend(toaddrs)
+
+
+def test_mailer_times_the_smtp_exchange_at_commit():
+    metrics = Metrics()
+    smtp_mailer = SlowSMTPMailer()
+    mailer = instrument_mailer(Mailer(smtp_mailer=smtp_mailer), metrics)
+    message = Message(subject="Hi", sender="robot@example.com",
+                      recipients=["boston@example.com"], body="Hello")
+
+    with transaction.manager:
+        with scope('send-reminders', metrics):
+            mailer.send(message)
+            ok_('threethings_smtp_send_seconds' not in metrics.render())
+            transaction.commit()
+
+    eq_(smtp_mailer.sent, ["boston@example.com"])
+    lines = metrics.render().splitlines()
+    ok_('threethings_smtp_send_seconds_count{'
+        'mode="direct",scope="send-reminders"} 1' in lines)
+    seconds, = [float(line.split()[-1]) for line in lines
+                if line.startswith('threethings_smtp_send_seconds_sum')]
+    ok_(seconds >= 0.05)
+
+
+def test_render_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    metrics.observe('latency', 0.002, buckets=(0.001, 0.01), route="a")
+    metrics.observe('latency', 0.02, buckets=(0.001, 0.01), route="a")
+
+    eq_(metrics.render().splitlines(), [
+        '# TYPE latency histogram',
+        'latency_bucket{route="a",le="0.001"} 0',
+        'latency_bucket{route="a",le="0.01"} 1',
+        'latency_bucket{route="a",le="+Inf"} 2',
+        'latency_sum{route="a"} 0.022',
+        'latency_count{route="a"} 2',
+    ])
+
+
+def test_scrape_needs_the_api_token_when_set():
+    from pyramid.config import Configurator
+    from webob import Request
+    config = Configurator(settings={'api.token': 's3cret'})
+    config.include('pyramid_tm')
+    config.include('threethings.web.metrics')
+    app = config.make_wsgi_app()
+
+    eq_(Request.blank('/metrics').get_response(app).status_int, 401)
+    scrape = Request.blank('/metrics',
+                           headers={'Authorization': 'Bearer s3cret'})
+    eq_(scrape.get_response(app).status_int, 200)
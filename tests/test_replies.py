@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_replies
+----------------------------------
+
+Tests for `threethings.replies` module.
+"""
+
+import io
+import os
+
+from email_reply_parser import EmailReplyParser
+
+from threethings import replies
+
+from nose.tools import *  # noqa
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'replies')
+
+
+def fixtures():
+    for name in sorted(os.listdir(FIXTURES)):
+        with io.open(os.path.join(FIXTURES, name), encoding='utf-8',
+                     newline='') as fixture:
+            yield name, fixture.read()
+
+
+def check_matches_email_reply_parser(name, text):
+    eq_(replies.strip_reply(text), EmailReplyParser.read(text).reply)
+
+
+def test_matches_email_reply_parser():
+    for name, text in fixtures():
+        yield check_matches_email_reply_parser, name, text
+
+
+def test_configure_picks_parser():
+    try:
+        replies.configure({'replies.parser': 'builtin'})
+        eq_(replies.parser, replies.strip_reply)
+        assert_raises(ValueError, replies.configure,
+                      {'replies.parser': 'nope'})
+    finally:
+        replies.configure({})
+    eq_(replies.parser, replies.email_reply_parser_reply)
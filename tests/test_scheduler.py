@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_scheduler
+----------------------------------
+
+Tests for `threethings.scheduler` module.
+"""
+
+import datetime
+import itertools
+
+import iso8601
+
+from threethings.scheduler import (
+    ReminderScheduler,
+    next_deadline,
+    next_due,
+)
+
+from nose.tools import *  # noqa
+
+
+def test_next_deadline_is_friday_afternoon_local():
+    after = iso8601.parse_date("2015-02-04T12:00:00Z")
+    eq_(next_deadline("US/Eastern", after),
+        iso8601.parse_date("2015-02-06T20:00:00Z"))
+    eq_(next_deadline("Singapore", after),
+        iso8601.parse_date("2015-02-06T07:00:00Z"))
+
+
+def test_next_due_rechecks_until_end_of_week():
+    recheck = datetime.timedelta(hours=1)
+    saturday = iso8601.parse_date("2015-02-07T12:00:00Z")
+    eq_(next_due("UTC", saturday, recheck), saturday + recheck)
+    sunday_night = iso8601.parse_date("2015-02-08T23:30:00Z")
+    eq_(next_due("UTC", sunday_night, recheck),
+        iso8601.parse_date("2015-02-13T15:00:00Z"))
+
+
+class FakeClock(object):
+
+    def __init__(self, when):
+        self.when = when
+
+    def __call__(self):
+        return self.when
+
+    def sleep(self, seconds):
+        self.when += datetime.timedelta(seconds=seconds)
+
+
+def test_scheduler_notifies_each_zone_at_its_deadline():
+    clock = FakeClock(iso8601.parse_date("2015-02-05T12:00:00Z"))
+    zones = ["US/Eastern", "Singapore"]
+
+    def notify(due_zones, when):
+        return [(when, due_zones)]
+
+    scheduler = ReminderScheduler(lambda: zones, notify,
+                                  refresh=datetime.timedelta(days=7),
+                                  clock=clock, sleep=clock.sleep)
+    runs = list(itertools.islice(scheduler.run(), 3))
+
+    eq_(runs[0], (iso8601.parse_date("2015-02-06T07:00:00Z"),
+                  ["Singapore"]))
+    eq_(runs[1], (iso8601.parse_date("2015-02-06T08:00:00Z"),
+                  ["Singapore"]))
+    eq_(runs[2], (iso8601.parse_date("2015-02-06T09:00:00Z"),
+                  ["Singapore"]))
+
+
+def test_scheduler_retries_zones_whose_notify_failed():
+    clock = FakeClock(iso8601.parse_date("2015-02-05T12:00:00Z"))
+    failures = [RuntimeError("SMTP timeout")]
+    recovered = []
+
+    def notify(due_zones, when):
+        if failures:
+            raise failures.pop()
+        return [(when, due_zones)]
+
+    scheduler = ReminderScheduler(lambda: ["Singapore"], notify,
+                                  refresh=datetime.timedelta(days=7),
+                                  retry=datetime.timedelta(minutes=5),
+                                  recover=lambda: recovered.append(True),
+                                  clock=clock, sleep=clock.sleep)
+    runs = list(itertools.islice(scheduler.run(), 1))
+
+    eq_(recovered, [True])
+    eq_(runs, [(iso8601.parse_date("2015-02-06T07:05:00Z"), ["Singapore"])])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_spool
+----------------------------------
+
+Tests for `threethings.spool` module.
+"""
+
+import os
+import shutil
+import tempfile
+
+from threethings.spool import (
+    Spool,
+    SpoolFlusher,
+)
+
+from nose.tools import *  # noqa
+
+directory = None
+
+
+def make_directory():
+    global directory
+    directory = tempfile.mkdtemp()
+
+
+def remove_directory():
+    shutil.rmtree(directory)
+
+
+class Transient(Exception):
+    pass
+
+
+class FlakyStore(object):
+    """Stores batches, failing those with a record in fail"""
+
+    def __init__(self, fail=(), error=ValueError):
+        self.stored = []
+        self.fail = set(fail)
+        self.error = error
+
+    def __call__(self, batch):
+        if self.fail.intersection(batch):
+            raise self.error("Can't store {}".format(batch))
+        self.stored.extend(batch)
+
+
+def spool_of(records):
+    spool = Spool(os.path.join(directory, 'inbound'))
+    for record in records:
+        spool.append(record)
+    return spool
+
+
+@with_setup(make_directory, remove_directory)
+def test_failed_flush_resumes_after_the_last_batch_stored():
+    store = FlakyStore(fail=[3])
+    flusher = SpoolFlusher(spool_of(range(5)), store, batch_size=2)
+    assert_raises(ValueError, flusher.flush)
+    eq_(store.stored, [0, 1])
+
+    # Left for the next flush, along with anything spooled since
+    flusher.spool.append(5)
+    store.fail.clear()
+    eq_(flusher.flush(), 4)
+    eq_(store.stored, [0, 1, 2, 3, 4, 5])
+    eq_(sorted(os.listdir(directory)), ['inbound.flush-lock', 'inbound.lock'])
+
+
+@with_setup(make_directory, remove_directory)
+def test_records_failing_every_attempt_are_moved_aside():
+    store = FlakyStore(fail=[2])
+    flusher = SpoolFlusher(spool_of(range(5)), store, batch_size=2,
+                           max_attempts=2)
+    assert_raises(ValueError, flusher.flush)
+    eq_(flusher.flush(), 3)
+    eq_(store.stored, [0, 1, 3, 4])
+
+    dead = Spool(flusher.spool.dead_path)
+    dead_letters = FlakyStore()
+    eq_(SpoolFlusher(dead, dead_letters).flush(), 1)
+    eq_(dead_letters.stored, [2])
+
+
+@with_setup(make_directory, remove_directory)
+def test_transient_errors_are_retried_indefinitely():
+    store = FlakyStore(fail=[0], error=Transient)
+    flusher = SpoolFlusher(spool_of(range(2)), store, max_attempts=1,
+                           transient=(Transient,))
+    for attempt in range(3):
+        assert_raises(Transient, flusher.flush)
+    store.fail.clear()
+    eq_(flusher.flush(), 2)
+    eq_(store.stored, [0, 1])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_templating
+----------------------------------
+
+Tests for `threethings.templating` module.
+"""
+
+import os
+import shutil
+import tempfile
+
+from threethings import templating
+
+from nose.tools import *  # noqa
+
+directory = None
+
+
+def setup_module():
+    global directory
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, 'overrides', 'teams', 'east'))
+    configure()
+
+
+def configure():
+    templating.configure({
+        'templates.directories': os.path.join(directory, 'overrides'),
+        'templates.module_directory': os.path.join(directory, 'modules'),
+    })
+
+
+def teardown_module():
+    templating.configure({})
+    shutil.rmtree(directory)
+
+
+def write_override(name, contents, mtime):
+    path = os.path.join(directory, 'overrides', name)
+    with open(path, 'w') as template:
+        template.write(contents)
+    os.utime(path, (mtime, mtime))
+
+
+def test_team_overrides_and_recompiles_changed_templates():
+    ok_("Thanks! I've got it." in templating.render('confirm.mako',
+                                                    'east'))
+    write_override('teams/east/confirm.mako', "Got it, ${who}", 1000)
+    configure()
+    eq_(templating.render('confirm.mako', 'east', who="east"),
+        "Got it, east")
+    ok_("Thanks! I've got it." in templating.render('confirm.mako'))
+
+    write_override('teams/east/confirm.mako', "Got it!", 2 ** 31 - 1)
+    configure()
+    eq_(templating.render('confirm.mako', 'east'), "Got it!")
+
+
+def test_unwritable_module_directory_compiles_in_memory():
+    not_a_directory = os.path.join(directory, 'file')
+    open(not_a_directory, 'w').close()
+    try:
+        templating.configure({
+            'templates.module_directory': os.path.join(not_a_directory, 'x'),
+        })
+        eq_(templating.module_directory, None)
+        ok_("Thanks! I've got it." in templating.render('confirm.mako'))
+    finally:
+        configure()
@@ -11,13 +11,23 @@ from threethings.model import (
     Session,
     Base,
     User,
+    Team,
     StatusUpdate,
+    WeeklySummary,
+    SummarySnapshot,
+    ArchivedBody,
+    OutboundEmail,
+    week_bucket,
+    week_of,
+    now,
 )
 
 from zope.sqlalchemy import mark_changed
 
 import iso8601
 import datetime
+import io
+import json
 
 import transaction
 
@@ -135,6 +145,526 @@ def test_notify_on_only_those_without_status_for_week():
     eq_(len(to_be_notified), 1)
 
 
+@with_setup(create_data, remove_data)
+def test_notify_skips_muted_users():
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        Session.query(User).get("boston@example.com").notifications_on = False
+        transaction.commit()
+    to_be_notified = list(User.to_notify(dt))
+    eq_([u.email_address for u in to_be_notified], ["singapore@example.com"])
+
+
+@with_setup(create_data, remove_data)
+def test_notification_query_matches_should_be_notified():
+    start = iso8601.parse_date("2015-02-04T00:00:00Z")
+    with transaction.manager:
+        did_status_update_hours_ago(start, -60, "boston@example.com")
+        transaction.commit()
+    for hour in range(0, 24 * 6, 5):
+        dt = start + datetime.timedelta(hours=hour)
+        expected = {u.email_address for u in Session.query(User)
+                    if u.should_be_notified(dt)}
+        planned = {u.email_address for u in User.to_notify(dt)}
+        eq_(planned, expected, dt)
+
+
+@with_setup(create_data, remove_data)
+def test_summary_lists_updates_and_missing_users():
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        did_status_update_hours_ago(dt, 12, "singapore@example.com")
+        did_status_update_hours_ago(dt, 2, "singapore@example.com")
+        transaction.commit()
+
+    summary = WeeklySummary(dt)
+    contents = summary.email_contents()
+
+    eq_(contents, "".join(summary.iter_email_contents()))
+    ok_("Week 6 of 2015" in contents)
+    ok_("<singapore@example.com>:\n\nDid some work\nDid some work\n"
+        in contents)
+    ok_("Sadly I didn't get updates from 1 people:\n"
+        " <boston@example.com>" in contents)
+
+
+@with_setup(create_data, remove_data)
+def test_summary_renders_in_two_queries():
+    from sqlalchemy import event
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        StatusUpdate.from_email("singapore@example.com", dt, "Some work")
+        StatusUpdate.from_email("singapore@example.com", dt, "More work")
+        StatusUpdate.from_email("boston@example.com", dt, "Other work")
+        transaction.commit()
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = Session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        with transaction.manager:
+            WeeklySummary(dt).email_contents()
+            transaction.abort()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    # Users with and without updates, then the updates
+    eq_(len(statements), 2, statements)
+
+
+@with_setup(create_data, remove_data)
+def test_closed_week_summary_is_snapshotted_until_new_update():
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        did_status_update_hours_ago(dt, 12, "singapore@example.com")
+        first = SummarySnapshot.for_week(dt)
+        eq_(first.addresses_with_updates(), ["singapore@example.com"])
+        transaction.commit()
+
+    with transaction.manager:
+        eq_(Session.query(SummarySnapshot).count(), 1)
+        StatusUpdate.from_email("boston@example.com", dt, "Late work")
+        eq_(Session.query(SummarySnapshot).count(), 0)
+        second = SummarySnapshot.for_week(dt)
+        eq_(second.addresses_with_updates(),
+            ["boston@example.com", "singapore@example.com"])
+        transaction.commit()
+
+
+@with_setup(create_data, remove_data)
+def test_team_scopes_reminders_and_summary():
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        team = Team()
+        team.name = "east"
+        Session.add(team)
+        Session.query(User).get("boston@example.com").team = team
+        transaction.commit()
+
+    with transaction.manager:
+        eq_([u.email_address for u in User.to_notify(dt, team="east")],
+            ["boston@example.com"])
+        update = StatusUpdate.from_email("boston@example.com", dt,
+                                         "East coast work")
+        StatusUpdate.from_email("singapore@example.com", dt, "Other work")
+        eq_(update.team_name, "east")
+        summary = WeeklySummary(dt, "east")
+        eq_([u.email_address for u in summary.updates], ["boston@example.com"])
+        eq_(summary.users_without_updates, set())
+        transaction.commit()
+
+
+@with_setup(create_data, remove_data)
+def test_export_updates_filters_and_streams_json_lines():
+    from threethings.cli import _export_updates
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        for hours in (30, 20, 10):
+            did_status_update_hours_ago(dt, hours, "singapore@example.com")
+        did_status_update_hours_ago(dt, 5, "boston@example.com")
+        transaction.commit()
+
+    out = io.BytesIO()
+    totals = list(_export_updates(out, 1, since=dt - datetime.timedelta(
+        hours=25), users=["singapore@example.com"]))
+    eq_(totals, [1, 2])
+    records = [json.loads(line)
+               for line in out.getvalue().decode('utf-8').splitlines()]
+    eq_([record['email'] for record in records],
+        ["singapore@example.com"] * 2)
+    eq_(records[0]['text'], "Did some work")
+    ok_(records[0]['when'] < records[1]['when'])
+
+
+@with_setup(create_data, remove_data)
+def test_archived_updates_keep_their_reply_inline():
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    raw = u"Shipped it \u2713\n\nOn Mon, Bob wrote:\n> what did you do?"
+    with transaction.manager:
+        StatusUpdate.from_email("boston@example.com", dt, raw)
+        StatusUpdate.from_email("boston@example.com",
+                                dt + datetime.timedelta(days=7), "Later")
+        eq_(ArchivedBody.archive_before(dt + datetime.timedelta(days=1),
+                                        batch_size=10), 1)
+        mark_changed(Session())
+        transaction.commit()
+
+    with transaction.manager:
+        old, new = StatusUpdate.updates_in_week(dt).all() + \
+            StatusUpdate.updates_in_week(dt + datetime.timedelta(days=7)).all()
+        eq_(old.raw_text, None)
+        eq_(old.text, u"Shipped it \u2713")
+        eq_(old.archived.raw_text, raw)
+        eq_(new.raw_text, "Later")
+        eq_(new.archived, None)
+
+
+@with_setup(create_data, remove_data)
+def test_repeat_deliveries_store_and_confirm_once():
+    from repoze.lru import LRUCache
+    from threethings.web.mailgun import process_inbound_email
+    event = {
+        'timestamp': ['1423260000'],
+        'sender': ['boston@example.com'],
+        'body-plain': ["Did some work"],
+        'body-html': ["<p>Did some work</p>"],
+        'subject': ["Re: Three things"],
+        'parsed_message_id': "<retried@example.com>",
+    }
+    seen = LRUCache(10)
+    with transaction.manager:
+        first, = process_inbound_email(event, seen)
+        first_id = first.id
+        transaction.commit()
+    eq_(seen.get("<retried@example.com>")['id'], first_id)
+
+    with transaction.manager:
+        again, = process_inbound_email(event, seen)
+        eq_(again['id'], first_id)
+        again, = process_inbound_email(event)
+        eq_(again.id, first_id)
+        eq_(Session.query(StatusUpdate).count(), 1)
+        eq_(Session.query(OutboundEmail).count(), 1)
+
+
+@with_setup(create_data, remove_data)
+def test_unknown_senders_are_dropped_without_an_error():
+    from threethings.web.mailgun import (
+        process_inbound_email,
+        store_spooled_emails,
+    )
+
+    def event(message_id):
+        return {
+            'timestamp': ['1423260000'],
+            'sender': ["nobody@example.com"],
+            'body-plain': ["Did some work"],
+            'subject': ["Re: Three things"],
+            'parsed_message_id': message_id,
+        }
+    with transaction.manager:
+        eq_(list(process_inbound_email(event("<1@example.com>"))), [])
+        eq_(list(process_inbound_email(event(None))), [])
+        transaction.commit()
+    eq_(store_spooled_emails([event("<2@example.com>")]), 0)
+    with transaction.manager:
+        eq_(Session.query(StatusUpdate).count(), 0)
+        eq_(Session.query(OutboundEmail).count(), 0)
+
+
+class FlakySMTP(object):
+    """Refuses mail to refused@example.com"""
+    sent = []
+
+    def __init__(self, host, port, timeout=None):
+        pass
+
+    def sendmail(self, sender, recipients, body):
+        import smtplib
+        if 'refused@example.com' in recipients:
+            raise smtplib.SMTPRecipientsRefused({})
+        self.sent.extend(recipients)
+
+    def quit(self):
+        pass
+
+    close = quit
+
+
+@with_setup(create_data, remove_data)
+def test_outbox_is_drained_once_and_failures_retried():
+    from threethings.cli import _drain_outbox_batch
+    from threethings.delivery import PooledDelivery
+    from threethings.email_processing import queue_confirm
+    with transaction.manager:
+        refused = User()
+        refused.email_address = "refused@example.com"
+        refused.timezone = "UTC"
+        Session.add(refused)
+        for user in User.all_users():
+            queue_confirm(user, reply_to_id="<1@example.com>",
+                          reply_to_subject="Three things")
+        transaction.commit()
+
+    FlakySMTP.sent = []
+    delivery = PooledDelivery(workers=1, connection_factory=FlakySMTP)
+    eq_(_drain_outbox_batch(delivery, 10), (2, 1))
+    eq_(sorted(FlakySMTP.sent), ["boston@example.com",
+                                 "singapore@example.com"])
+    with transaction.manager:
+        outbox = dict((json.loads(email.recipients)[0], email)
+                      for email in Session.query(OutboundEmail))
+        delivered = outbox["boston@example.com"]
+        ok_(delivered.sent is not None)
+        eq_((delivered.attempts, delivered.last_error), (1, None))
+        eq_(delivered.subject, "Re: Three things")
+        failed = outbox["refused@example.com"]
+        eq_((failed.sent, failed.attempts), (None, 1))
+        ok_(failed.last_error)
+
+    # Only the failure is tried again, once its backoff has passed, until
+    # it runs out of attempts
+    eq_(_drain_outbox_batch(delivery, 10), (0, 0))
+    for attempt in range(2, OutboundEmail.MAX_ATTEMPTS + 1):
+        later = now() + datetime.timedelta(days=attempt)
+        eq_(_drain_outbox_batch(delivery, 10, later), (0, 1))
+    eq_(_drain_outbox_batch(delivery, 10, now() + datetime.timedelta(
+        days=OutboundEmail.MAX_ATTEMPTS + 1)), (0, 0))
+    eq_(len(FlakySMTP.sent), 2)
+    with transaction.manager:
+        failed = Session.query(OutboundEmail).filter(
+            OutboundEmail.sent == None  # noqa
+        ).one()
+        eq_(failed.attempts, OutboundEmail.MAX_ATTEMPTS)
+
+
+class DownSMTP(object):
+    """Refuses to connect, as during an outage"""
+
+    def __init__(self, host, port, timeout=None):
+        import socket
+        raise socket.error("Connection refused")
+
+
+@with_setup(create_data, remove_data)
+def test_outbox_backs_off_while_smtp_is_down():
+    from threethings.cli import _drain_outbox_batch
+    from threethings.delivery import PooledDelivery
+    from threethings.email_processing import queue_confirm
+    with transaction.manager:
+        queue_confirm(Session.query(User).get("boston@example.com"),
+                      reply_to_id="<1@example.com>",
+                      reply_to_subject="Three things")
+        transaction.commit()
+
+    delivery = PooledDelivery(workers=1, connection_factory=DownSMTP)
+    start = now()
+    delay = OutboundEmail.RETRY_DELAY
+    # Draining again straight away doesn't use up attempts
+    eq_(_drain_outbox_batch(delivery, 10, start), (0, 1))
+    eq_(_drain_outbox_batch(delivery, 10, start), (0, 0))
+    eq_(_drain_outbox_batch(delivery, 10, start + delay / 2), (0, 0))
+    eq_(_drain_outbox_batch(delivery, 10, start + delay), (0, 1))
+    # Then twice as long
+    eq_(_drain_outbox_batch(delivery, 10, start + delay * 2), (0, 0))
+    eq_(_drain_outbox_batch(delivery, 10, start + delay * 3), (0, 1))
+    with transaction.manager:
+        outbound = Session.query(OutboundEmail).one()
+        eq_((outbound.sent, outbound.attempts), (None, 3))
+        eq_(outbound.next_attempt, start + delay * 7)
+
+
+@with_setup(create_data, remove_data)
+def test_spooled_emails_are_stored_in_batches():
+    import shutil
+    import tempfile
+    from threethings.spool import Spool, SpoolFlusher
+    from threethings.web.mailgun import (
+        spool_inbound_email,
+        store_spooled_emails,
+    )
+
+    def event(sender, message_id):
+        return {
+            'timestamp': ['1423260000'],
+            'sender': [sender],
+            'body-plain': ["Did some work"],
+            'subject': ["Re: Three things"],
+            'parsed_message_id': message_id,
+        }
+    directory = tempfile.mkdtemp()
+    try:
+        flusher = SpoolFlusher(Spool(directory + '/inbound'),
+                               store_spooled_emails, batch_size=2)
+        events = [event("boston@example.com", "<1@example.com>"),
+                  event("boston@example.com", "<1@example.com>"),
+                  event("nobody@example.com", "<2@example.com>"),
+                  event("singapore@example.com", "<3@example.com>")]
+        for spooled in events:
+            response, = spool_inbound_email(spooled, flusher)
+            ok_(response['spooled'])
+        assert_raises(ValueError, spool_inbound_email,
+                      event("boston@example.com", None), flusher)
+        eq_(Session.query(StatusUpdate).count(), 0)
+        eq_(flusher.flush(), 4)
+        eq_(flusher.flush(), 0)
+
+        # As if replayed after a crash
+        for spooled in events:
+            spool_inbound_email(spooled, flusher)
+        eq_(flusher.flush(), 4)
+    finally:
+        shutil.rmtree(directory)
+
+    with transaction.manager:
+        updates = Session.query(StatusUpdate).order_by(StatusUpdate.id).all()
+        eq_([(update.email_address, update.message_id, update.team_name)
+             for update in updates],
+            [("boston@example.com", "<1@example.com>", None),
+             ("singapore@example.com", "<3@example.com>", None)])
+        eq_(updates[0].text, "Did some work")
+        eq_(updates[0].week, week_bucket(updates[0].when))
+        eq_(StatusUpdate.search("work").count(), 2)
+        eq_(Session.query(OutboundEmail).count(), 2)
+
+
+@with_setup(create_data, remove_data)
+def test_search_ranks_matching_updates():
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        StatusUpdate.from_email("boston@example.com", dt,
+                                "Started the billing migration")
+        StatusUpdate.from_email("singapore@example.com", dt,
+                                "Billing: migrated invoices to billing v2")
+        StatusUpdate.from_email("singapore@example.com", dt, "Hiring")
+        transaction.commit()
+
+    with transaction.manager:
+        matches = StatusUpdate.search("billing").all()
+        eq_([update.email_address for update, rank in matches],
+            ["singapore@example.com", "boston@example.com"])
+        ok_(matches[0][1] > matches[1][1])
+        eq_([update.email_address for update, rank in
+             StatusUpdate.search("starting billing")],
+            ["boston@example.com"])
+
+
+def test_search_result_without_user():
+    from threethings.web.search import search_result
+    update = StatusUpdate(email_address="gone@example.com",
+                          when=iso8601.parse_date("2015-02-06T22:00:00Z"),
+                          raw_text="Billing")
+    eq_(search_result(update, 0.5, None)['full_name'], "gone@example.com")
+
+
+@with_setup(create_data, remove_data)
+def test_api_pages_updates_and_answers_not_modified():
+    from pyramid.registry import Registry
+    from pyramid.request import Request
+    from threethings.web.api import updates_in_week
+    dt = iso8601.parse_date("2015-02-06T22:00:00Z")
+    with transaction.manager:
+        for hours in (3, 2, 1):
+            did_status_update_hours_ago(dt, hours, "boston@example.com")
+        transaction.commit()
+
+    def get(query, **headers):
+        request = Request.blank('/api/weeks/201506/updates?' + query,
+                                headers=headers)
+        request.registry = Registry()
+        request.matchdict = {'week': '201506'}
+        with transaction.manager:
+            return request, updates_in_week(request)
+
+    request, first = get('limit=2')
+    eq_(len(first['updates']), 2)
+    request, second = get('limit=2&after=' + first['next'])
+    eq_(len(second['updates']), 1)
+    eq_(second['next'], None)
+    ok_(first['updates'][1]['when'] < second['updates'][0]['when'])
+
+    request, _ = get('limit=2')
+    etag = request.response.headers['ETag']
+    eq_(get('limit=2', **{'If-None-Match': etag})[1].status_code, 304)
+    with transaction.manager:
+        did_status_update_hours_ago(dt, 4, "boston@example.com")
+        transaction.commit()
+    ok_(isinstance(get('limit=2', **{'If-None-Match': etag})[1], dict))
+
+    request, _ = get('limit=2')
+    etag = request.response.headers['ETag']
+    last_modified = request.response.headers['Last-Modified']
+    with transaction.manager:
+        Session.delete(Session.query(StatusUpdate)
+                       .order_by(StatusUpdate.when).first())
+        transaction.commit()
+    ok_(isinstance(get('limit=2', **{'If-None-Match': etag})[1], dict))
+    ok_(isinstance(get('limit=2',
+                       **{'If-Modified-Since': last_modified})[1], dict))
+
+    # As backfill_reply_text does
+    request, _ = get('limit=2')
+    etag = request.response.headers['ETag']
+    with transaction.manager:
+        Session.query(StatusUpdate).update(
+            {StatusUpdate.reply_text: "Reparsed"}, synchronize_session=False
+        )
+        mark_changed(Session())
+        transaction.commit()
+    ok_(isinstance(get('limit=2', **{'If-None-Match': etag})[1], dict))
+
+
+def test_api_token_required_when_set():
+    from pyramid.httpexceptions import HTTPUnauthorized
+    from pyramid.registry import Registry
+    from pyramid.request import Request
+    from threethings.web.api import token_required
+    view = token_required(lambda context, request: {'ok': True})
+
+    def call(settings, **headers):
+        request = Request.blank('/api/users', headers=headers)
+        request.registry = Registry()
+        request.registry.settings = settings
+        return view(None, request)
+
+    eq_(call({}), {'ok': True})
+    eq_(call({'api.token': 's3cret'}, Authorization='Bearer s3cret'),
+        {'ok': True})
+    assert_raises(HTTPUnauthorized, call, {'api.token': 's3cret'})
+    assert_raises(HTTPUnauthorized, call, {'api.token': 's3cret'},
+                  Authorization='Bearer wrong')
+
+
+@with_setup(create_data, remove_data)
+def test_import_users_adds_new_users_in_chunks():
+    from threethings.cli import _import_users
+    with transaction.manager:
+        team = Team()
+        team.name = "east"
+        Session.add(team)
+        transaction.commit()
+    records = [
+        {'email_address': 'new1@example.com', 'full_name': 'New One'},
+        {'email_address': 'boston@example.com'},
+        {'email_address': 'new2@example.com', 'team': 'east',
+         'timezone': 'Europe/Paris'},
+        # Next chunk, and already added by the first
+        {'email_address': 'new1@example.com'},
+        {'email_address': 'new3@example.com', 'timezone': 'Mars/Olympus'},
+        {'email_address': 'new4@example.com', 'team': 'west'},
+        {'email_address': 'new4@example.com'},
+    ]
+    lines = list(_import_users(records, 'UTC', chunk_size=3))
+    ok_("Skipped new3@example.com: unknown timezone Mars/Olympus" in lines)
+    ok_("Skipped new4@example.com: unknown team west" in lines)
+    ok_(lines[-1].startswith("Done: imported 3 users, skipped 4 in "))
+
+    with transaction.manager:
+        users = dict((user.email_address, user) for user in User.all_users())
+        eq_(sorted(users), ["boston@example.com", "new1@example.com",
+                            "new2@example.com", "new4@example.com",
+                            "singapore@example.com"])
+        eq_(users["new1@example.com"].full_name, "New One")
+        eq_(users["new1@example.com"].timezone, "UTC")
+        eq_((users["new2@example.com"].team_name,
+             users["new2@example.com"].timezone), ("east", "Europe/Paris"))
+        eq_(users["boston@example.com"].timezone, "US/Eastern")
+        eq_(sorted(json.loads(email.recipients)[0]
+                   for email in Session.query(OutboundEmail)),
+            ["new1@example.com", "new2@example.com", "new4@example.com"])
+
+
+def test_week_bucket_includes_monday_morning():
+    monday = iso8601.parse_date("2015-02-09T19:00:00Z")
+    eq_(week_of(monday), 201507)
+    eq_(week_bucket(monday), 201506)
+    eq_(week_bucket(monday + datetime.timedelta(seconds=1)), 201507)
+    eq_(week_bucket(iso8601.parse_date("2015-02-09T10:00:00-08:00")),
+        201506)
+
+
 def did_status_update_hours_ago(dt, hours, user):
     user = Session.query(User).get(user)
     update = StatusUpdate()
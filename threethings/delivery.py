@@ -0,0 +1,190 @@
+"""Pooled, concurrent SMTP delivery for bulk outbound mail"""
+import smtplib
+import threading
+import time
+
+from collections import (
+    namedtuple,
+)
+
+from pyramid.settings import (
+    asbool,
+)
+
+from .metrics import (
+    SMTP_SEND,
+    SMTP_SEND_HELP,
+    timed,
+)
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+class DeliveryResult(namedtuple('DeliveryResult', 'key message error')):
+    """Outcome of delivering one message, error is None if it was accepted"""
+
+    @property
+    def accepted(self):
+        return self.error is None
+
+
+class RateLimiter(object):
+    """Spaces calls to wait() so at most rate happen per second"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_slot = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            current = time.time()
+            slot = max(current, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > current:
+            time.sleep(slot - current)
+
+
+class PooledDelivery(object):
+    """Send messages through a bounded pool of workers, each keeping its
+    own SMTP connection open for as many messages as it can."""
+
+    def __init__(self, host='localhost', port=25, username=None,
+                 password=None, tls=False, ssl=False, timeout=30,
+                 workers=DEFAULT_WORKERS, rate=None,
+                 connection_factory=None):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.tls = tls
+        self.ssl = ssl
+        self.timeout = timeout
+        self.workers = max(1, int(workers))
+        self.rate_limiter = RateLimiter(rate)
+        if connection_factory is None:
+            if ssl:
+                connection_factory = smtplib.SMTP_SSL
+            else:
+                connection_factory = smtplib.SMTP
+        self.connection_factory = connection_factory
+
+    @classmethod
+    def from_settings(cls, settings, prefix='mail.', **overrides):
+        """Build from the same settings pyramid_mailer reads, plus
+        mail.pool_size and mail.rate_limit (messages per second).
+        Overrides that are not None replace the matching setting."""
+        settings = dict(settings)
+        for name, value in overrides.items():
+            if value is not None:
+                settings[prefix + name] = value
+
+        def setting(name, default=None):
+            return settings.get(prefix + name, default)
+
+        rate = setting('rate_limit')
+        return cls(host=setting('host', 'localhost'),
+                   port=setting('port', 25),
+                   username=setting('username'),
+                   password=setting('password'),
+                   tls=asbool(setting('tls', False)),
+                   ssl=asbool(setting('ssl', False)),
+                   timeout=float(setting('timeout', 30)),
+                   workers=int(setting('pool_size', DEFAULT_WORKERS)),
+                   rate=float(rate) if rate else None)
+
+    def connect(self):
+        connection = self.connection_factory(self.host, self.port,
+                                             timeout=self.timeout)
+        if self.tls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def send_all(self, jobs):
+        """Deliver (key, message) pairs, yielding a DeliveryResult for each
+        as soon as it is known. key identifies the message to the caller."""
+        jobs = list(jobs)
+        pending = Queue()
+        results = Queue()
+        for job in jobs:
+            pending.put(job)
+        workers = []
+        for i in range(min(self.workers, len(jobs))):
+            pending.put(None)
+            worker = threading.Thread(target=self._work,
+                                      args=(pending, results),
+                                      name="delivery-{}".format(i))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for i in range(len(jobs)):
+            yield results.get()
+        for worker in workers:
+            worker.join()
+
+    def _work(self, pending, results):
+        connection = None
+        try:
+            while True:
+                job = pending.get()
+                if job is None:
+                    break
+                key, message = job
+                self.rate_limiter.wait()
+                try:
+                    connection = self._send(connection, message)
+                except Exception as e:
+                    log.warning("Delivery to %s failed: %s", key, e)
+                    # smtplib resets the session after a refused message
+                    if (not isinstance(e, smtplib.SMTPException) or
+                            isinstance(e, smtplib.SMTPServerDisconnected)):
+                        connection = self._close(connection)
+                    results.put(DeliveryResult(key, message, e))
+                else:
+                    results.put(DeliveryResult(key, message, None))
+        finally:
+            self._close(connection, quit=True)
+
+    def _send(self, connection, message):
+        """Send message, (re)connecting as needed. Returns the connection"""
+        with timed(SMTP_SEND, help=SMTP_SEND_HELP, mode='pooled'):
+            return self._send_untimed(connection, message)
+
+    def _send_untimed(self, connection, message):
+        email = message.to_message()
+        recipients = list(message.send_to)
+        if connection is not None:
+            try:
+                connection.sendmail(message.sender, recipients,
+                                    email.as_string())
+                return connection
+            except smtplib.SMTPServerDisconnected:
+                log.debug("SMTP connection dropped, reconnecting")
+        connection = self.connect()
+        connection.sendmail(message.sender, recipients, email.as_string())
+        return connection
+
+    def _close(self, connection, quit=False):
+        if connection is not None:
+            try:
+                if quit:
+                    connection.quit()
+                else:
+                    connection.close()
+            except smtplib.SMTPException:
+                pass
+            except IOError:
+                pass
+        return None
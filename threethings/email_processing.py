@@ -1,6 +1,12 @@
 from pyramid_mailer.message import (
     Message,
 )
+from .model import (
+    OutboundEmail,
+)
+from .templating import (
+    render,
+)
 
 import logging
 log = logging.getLogger(__name__)
@@ -9,39 +15,38 @@ log = logging.getLogger(__name__)
 # FROM = '3things Status Updates <status-update@in.lexmachina.com>'
 FROM = '3things Status Updates <status-update@mg2.lexmachina.com>'
 
-NOTIFICATION_TEMPLATE = """
-Hi,
-
-Please reply with your weekly status update! Three simple things that
-you did last week, and three things you're planning on doing next week.
-
-Cheers,
-Friendly Robot
-"""
 
-
-def send_notification(mailer, user, for_week):
+def notification_message(user, for_week):
     year, week_number, day_number = for_week.isocalendar()
     subject = "Status Reminder for Week {} of {}".format(week_number,
                                                          year)
-    message = Message(subject=subject,
-                      sender=FROM,
-                      recipients=[user.email_address],
-                      body=NOTIFICATION_TEMPLATE)
+    return Message(subject=subject,
+                   sender=FROM,
+                   recipients=[user.email_address],
+                   body=render('notification.mako', user.team_name,
+                               user=user, week=week_number, year=year))
+
+
+def send_notification(mailer, user, for_week):
+    message = notification_message(user, for_week)
     mailer.send(message)
     user.last_notified = for_week
     return message
 
 
-CONFIRM_TEMPLATE = """
-Thanks! I've got it.
+def send_confirm(mailer, user, reply_to_id=None, reply_to_subject=None):
+    message = confirm_message(user, reply_to_id, reply_to_subject)
+    mailer.send(message)
+    return message
+
 
-Cheers,
-Friendly Robot
-"""
+def queue_confirm(user, reply_to_id=None, reply_to_subject=None):
+    """Record a confirmation in the outbox for drain_outbox to send"""
+    message = confirm_message(user, reply_to_id, reply_to_subject)
+    return OutboundEmail.from_message(message)
 
 
-def send_confirm(mailer, user, reply_to_id=None, reply_to_subject=None):
+def confirm_message(user, reply_to_id=None, reply_to_subject=None):
     headers = {}
 
     if reply_to_id is not None:
@@ -55,36 +60,23 @@ def send_confirm(mailer, user, reply_to_id=None, reply_to_subject=None):
     message = Message(subject=subject,
                       sender=FROM,
                       recipients=[user.email_address],
-                      body=CONFIRM_TEMPLATE,
+                      body=render('confirm.mako', user.team_name,
+                                  user=user),
                       extra_headers=headers,
                       )
-    mailer.send(message)
     return message
 
 
-WELCOME_MESSAGE_TEMPLATE = """
-Hi there!
-
-Welcome to the 3things status update email workflow awesomeness tool with
-power features. Every week you'll get an email from me asking you to tell
-me what what you've been doing this week, and what your planning on doing
-next week. Just reply to that email and I'll make sure to let everyone else
-on your team know what you've been up to.
-
-You can also send me an email at any time before I remind you! I'll keep
-track of all the emails you send me in a week and summarize them on Monday
-morning.
-
-See you next Friday!
-Friendly Robot
-"""
-
-
 def welcome_user(mailer, user):
-    message = Message(subject="Welcome to 3things!",
-                      sender=FROM,
-                      recipients=[user.email_address],
-                      body=WELCOME_MESSAGE_TEMPLATE,
-                      )
+    message = welcome_message(user)
     mailer.send(message)
     return user
+
+
+def welcome_message(user):
+    return Message(subject="Welcome to 3things!",
+                   sender=FROM,
+                   recipients=[user.email_address],
+                   body=render('welcome.mako', user.team_name,
+                               user=user),
+                   )
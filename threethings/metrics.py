@@ -0,0 +1,204 @@
+"""SQL statement and SMTP timings, exposed in Prometheus' text format.
+
+Statements are labelled with the threethings function that issued them
+(call_site) and with the current scope: the route of a web request or the
+name of a CLI command.
+"""
+import sys
+import threading
+import time
+
+from collections import (
+    defaultdict,
+)
+from contextlib import (
+    contextmanager,
+)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+NO_SCOPE = 'none'
+
+_local = threading.local()
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics(object):
+    """Histograms keyed by metric name and label values"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = defaultdict(dict)
+        self._help = {}
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, help=None,
+                **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if help is not None:
+                self._help[name] = help
+            histograms = self._histograms[name]
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._histograms):
+                if name in self._help:
+                    lines.append("# HELP {} {}".format(name,
+                                                       self._help[name]))
+                lines.append("# TYPE {} histogram".format(name))
+                for key, histogram in sorted(self._histograms[name].items()):
+                    lines.extend(_render_histogram(name, key, histogram))
+        return "\n".join(lines) + "\n"
+
+
+def _render_histogram(name, key, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        yield "{}_bucket{} {}".format(
+            name, _labels(key + (('le', repr(float(bound))),)), cumulative
+        )
+    yield "{}_bucket{} {}".format(name, _labels(key + (('le', '+Inf'),)),
+                                  histogram.count)
+    yield "{}_sum{} {!r}".format(name, _labels(key), histogram.sum)
+    yield "{}_count{} {}".format(name, _labels(key), histogram.count)
+
+
+def _labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in key
+    ) + "}"
+
+
+registry = Metrics()
+
+
+def current_scope():
+    return getattr(_local, 'scope', NO_SCOPE)
+
+
+def set_scope(name):
+    """Rename the current scope, e.g. once a request's route is known"""
+    if hasattr(_local, 'scope'):
+        _local.scope = name
+
+
+@contextmanager
+def scope(name, metrics=registry):
+    """Attribute statements issued within to name. On exit, records how
+    many statements the scope issued and how long it took."""
+    previous = (getattr(_local, 'scope', None),
+                getattr(_local, 'statements', 0))
+    _local.scope = name
+    _local.statements = 0
+    started = time.time()
+    try:
+        yield
+    finally:
+        name = _local.scope
+        metrics.observe('threethings_scope_seconds', time.time() - started,
+                        help="Duration of web requests and CLI commands",
+                        scope=name)
+        metrics.observe('threethings_scope_sql_statements',
+                        _local.statements, buckets=COUNT_BUCKETS,
+                        help="SQL statements per web request or CLI command",
+                        scope=name)
+        if previous[0] is None:
+            del _local.scope
+        else:
+            _local.scope = previous[0]
+        _local.statements = previous[1]
+
+
+def call_site():
+    """module:function of the innermost threethings frame outside this
+    module"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('threethings') and module != __name__:
+            return "{}:{}".format(module, frame.f_code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+
+def instrument_engine(engine, metrics=registry):
+    """Time every statement engine executes"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context, executemany):
+        conn.info.setdefault('threethings_started', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters,
+                             context, executemany):
+        elapsed = time.time() - conn.info['threethings_started'].pop()
+        _local.statements = getattr(_local, 'statements', 0) + 1
+        metrics.observe('threethings_sql_statement_seconds', elapsed,
+                        help="SQL statement latency",
+                        call_site=call_site(), scope=current_scope())
+
+    return engine
+
+
+SMTP_SEND = 'threethings_smtp_send_seconds'
+SMTP_SEND_HELP = "Time taken to hand a message to the SMTP server"
+
+
+@contextmanager
+def timed(name, metrics=registry, help=None, **labels):
+    started = time.time()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.time() - started, help=help,
+                        scope=current_scope(), **labels)
+
+
+def instrument_mailer(mailer, metrics=registry):
+    """Time the SMTP exchanges of a pyramid_mailer Mailer. Its send() only
+    joins the transaction, messages go out to the SMTP server at commit."""
+    smtp_mailer = getattr(mailer, 'smtp_mailer', None)
+    if smtp_mailer is None:
+        return mailer
+    send = smtp_mailer.send
+
+    def timed_smtp_send(*args, **kwargs):
+        with timed(SMTP_SEND, metrics, help=SMTP_SEND_HELP, mode='direct'):
+            return send(*args, **kwargs)
+    smtp_mailer.send = timed_smtp_send
+    return mailer
@@ -2,17 +2,34 @@
 
 from sqlalchemy import (
     and_,
+    or_,
+    not_,
+    exists,
+    false,
+    select,
+    func,
+    inspect,
+    event,
     Column,
+    Index,
     Integer,
     Text,
     ForeignKey,
     DateTime,
     Boolean,
+    LargeBinary,
+    TypeDecorator,
+)
+from sqlalchemy.dialects.postgresql import (
+    TSVECTOR,
+    insert,
 )
 from sqlalchemy.orm import (
     scoped_session,
     sessionmaker,
     relation,
+    joinedload,
+    defer,
 )
 from zope.sqlalchemy import ZopeTransactionExtension
 
@@ -24,7 +41,16 @@ from functools import (
 )
 from collections import (
     defaultdict,
+    OrderedDict,
+)
+from itertools import (
+    groupby,
 )
+from operator import (
+    attrgetter,
+)
+import json
+import zlib
 import pytz
 
 from datetime import (
@@ -32,7 +58,10 @@ from datetime import (
     timedelta,
 )
 
-from mako.template import Template
+from . import replies
+from .templating import (
+    render,
+)
 
 import logging
 
@@ -44,6 +73,99 @@ Base = declarative_base()
 now = partial(datetime.now, tz=pytz.UTC)
 
 FRIDAY = 5
+EXPECTED_UPDATE_HOUR = 15
+NOTIFICATION_INTERVAL = timedelta(hours=24)
+
+# Updates received up to 1900 utc (11 am PST) on a monday still count
+# towards the previous isoweek.
+# This is intended to catch any last minute updates
+# It's assumed users will not send in new updates on a monday
+# And assumes mail will be automatically delivered at 11 am PST
+LATE_UPDATE_GRACE = timedelta(hours=19)
+
+# Text search configuration status updates are indexed and searched with
+SEARCH_CONFIG = 'english'
+
+
+def week_of(day):
+    """Week bucket (iso year * 100 + iso week) of the isoweek day is in"""
+    year, week, week_day = day.isocalendar()
+    return year * 100 + week
+
+
+def week_bucket(when):
+    """Week bucket an update received at when counts towards"""
+    received = when.astimezone(pytz.UTC)
+    # The grace period is inclusive of 1900 utc itself
+    return week_of(received - LATE_UPDATE_GRACE - timedelta(microseconds=1))
+
+
+def week_closes(day):
+    """When the isoweek day is in stops accepting updates"""
+    monday = day.date() - timedelta(days=day.isoweekday() - 1)
+    start = datetime(monday.year, monday.month, monday.day, tzinfo=pytz.UTC)
+    return start + timedelta(days=7) + LATE_UPDATE_GRACE
+
+
+_timezones = {}
+
+
+def get_timezone(name):
+    """pytz timezone called name, resolved once per process"""
+    try:
+        return _timezones[name]
+    except KeyError:
+        tz = _timezones[name] = pytz.timezone(name)
+        return tz
+
+
+def is_after_expected_update_time(localtime):
+    day = localtime.isoweekday()
+    hour = localtime.hour
+    if day == FRIDAY and hour >= EXPECTED_UPDATE_HOUR:
+        return True
+    elif day > FRIDAY:
+        return True
+    else:
+        return False
+
+
+def weeks_due(zones, when):
+    """Group the timezones in which users are due a reminder at when by the
+    week bucket the reminder is for"""
+    due = defaultdict(list)
+    for zone in zones:
+        localtime = when.astimezone(get_timezone(zone))
+        if is_after_expected_update_time(localtime):
+            due[week_of(localtime)].append(zone)
+    return due
+
+
+class CompressedText(TypeDecorator):
+    """Text stored zlib compressed in a bytea. Values start with a NUL byte
+    (which text never does) so rows written before the column was
+    compressed still read back as plain UTF-8."""
+    impl = LargeBinary
+
+    MARKER = b'\x00'
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return self.MARKER + zlib.compress(value.encode('utf-8'))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        if value[:1] == self.MARKER:
+            value = zlib.decompress(value[1:])
+        return value.decode('utf-8')
+
+
+def parse_reply(raw_text):
+    """Strip quoted replies and signatures from an email body"""
+    return replies.parser(raw_text)
 
 
 class StatusUpdate(Base):
@@ -51,48 +173,134 @@ class StatusUpdate(Base):
 
     id = Column(Integer, primary_key=True)
     email_address = Column(Text, ForeignKey('users.email_address'))
-    raw_text = Column(Text, nullable=False)
-    raw_html = Column(Text, nullable=True)
+    # NULL once archived, see ArchivedBody
+    raw_text = Column(CompressedText, nullable=True)
+    raw_html = Column(CompressedText, nullable=True)
+    reply_text = Column(Text, nullable=True)
     when = Column(DateTime(timezone=True), nullable=False, default=now)
+    week = Column(Integer, nullable=True)
+    team_name = Column(Text, ForeignKey('teams.name'), nullable=True)
+    # Message-Id of the email, repeat deliveries of it are ignored
+    message_id = Column(Text, nullable=True)
+    # Of the parsed reply, kept up to date by _set_search_vector
+    search_vector = Column(TSVECTOR, nullable=True)
+    # When it was stored, when is when it was sent. NULL on old rows.
+    received = Column(DateTime(timezone=True), nullable=True, default=now)
+
+    __table_args__ = (
+        Index('ix_status_updates_email_address_week', email_address, week),
+        Index('ix_status_updates_week_when', week, when),
+        Index('ix_status_updates_team_name_week', team_name, week),
+        Index('ix_status_updates_message_id', message_id, unique=True),
+        Index('ix_status_updates_search_vector', search_vector,
+              postgresql_using='gin'),
+        Index('ix_status_updates_when_id', when, id),
+    )
+
+    archived = relation('ArchivedBody', uselist=False,
+                        passive_deletes=True)
 
     @property
     def text(self):
-        from email_reply_parser import EmailReplyParser
-        message = EmailReplyParser.read(self.raw_text)
-        return message.reply
-
-    @classmethod
-    def updates_in_week(cls, day_in_week):
-        for_year, for_week, week_day = day_in_week.isocalendar()
-        # Offset to include monday till 1900 utc (11 am PST)
-        # after day_in_week's isoweek
-        # This is intended to catch any last minute updates
-        # It's assumed users will not send in new updates on a monday
-        # And assumes mail will be automatically delivered at 11 am PST
-        start_date = day_in_week - timedelta(days=(week_day - 1))
-        padded_start_date = start_date + timedelta(days=0, hours=17, seconds=1)
-        end_date = start_date + timedelta(days=7, hours=19)
+        if self.reply_text is not None:
+            return self.reply_text
+        return parse_reply(self.raw_text)
 
+    @classmethod
+    def updates_in_week(cls, day_in_week, team=None):
         q = Session.query(cls)
-        q = q.filter(and_(
-            cls.when >= padded_start_date,
-            cls.when <= end_date,
-        ))
-
+        q = q.filter(cls.week == week_of(day_in_week))
+        if team is not None:
+            q = q.filter(cls.team_name == team)
         q = q.order_by(cls.when)
-
         return q
 
     @classmethod
-    def from_email(cls, author, when, text, html=None):
+    def for_message_id(cls, message_id):
+        q = Session.query(cls).filter(cls.message_id == message_id)
+        return q.first()
+
+    @classmethod
+    def from_email(cls, author, when, text, html=None, message_id=None):
         update = StatusUpdate()
         update.raw_text = text
+        update.reply_text = parse_reply(text)
         update.when = when
         update.email_address = author
+        update.message_id = message_id
+        # The author's team when the update was sent, without a round trip
+        update.team_name = select([User.team_name]).where(
+            User.email_address == author
+        ).as_scalar()
         Session.add(update)
         Session.flush()
+        SummarySnapshot.invalidate(update.week)
         return update
 
+    @classmethod
+    def insert_many(cls, emails):
+        """Store emails, dicts of from_email's arguments, with one multi-row
+        INSERT. Emails from unknown senders are dropped and those with a
+        Message-Id already stored skipped. Returns the (id, email_address,
+        message_id, when) of the updates stored."""
+        authors = set(email['author'] for email in emails)
+        q = Session.query(User.email_address, User.team_name)
+        teams = dict(q.filter(User.email_address.in_(authors)))
+        rows = []
+        for email in emails:
+            if email['author'] not in teams:
+                log.warning("Dropping update from unknown sender %s",
+                            email['author'])
+                continue
+            reply_text = parse_reply(email['text'])
+            rows.append({
+                'email_address': email['author'],
+                'raw_text': email['text'],
+                'raw_html': email.get('html'),
+                'reply_text': reply_text,
+                'when': email['when'],
+                'week': week_bucket(email['when']),
+                'team_name': teams[email['author']],
+                'message_id': email.get('message_id'),
+                'search_vector': cls.search_vector_of(reply_text),
+                'received': now(),
+            })
+        if not rows:
+            return []
+        updates = cls.__table__
+        statement = insert(updates).values(rows)
+        statement = statement.on_conflict_do_nothing(
+            index_elements=[updates.c.message_id]
+        )
+        statement = statement.returning(updates.c.id,
+                                        updates.c.email_address,
+                                        updates.c.message_id,
+                                        updates.c.when)
+        stored = Session.execute(statement).fetchall()
+        for week in set(week_bucket(row.when) for row in stored):
+            SummarySnapshot.invalidate(week)
+        return stored
+
+    @classmethod
+    def search(cls, terms, team=None):
+        """Query for (update, rank) of updates matching terms (plain text,
+        every word must match), best match first"""
+        query = func.plainto_tsquery(SEARCH_CONFIG, terms)
+        rank = func.ts_rank_cd(cls.search_vector, query)
+        q = Session.query(cls, rank.label('rank'))
+        q = q.options(joinedload(cls.user),
+                      defer(cls.raw_text),
+                      defer(cls.raw_html))
+        q = q.filter(cls.search_vector.op('@@')(query))
+        if team is not None:
+            q = q.filter(cls.team_name == team)
+        q = q.order_by(rank.desc(), cls.when.desc(), cls.id.desc())
+        return q
+
+    @staticmethod
+    def search_vector_of(text):
+        return func.to_tsvector(SEARCH_CONFIG, text or '')
+
     def __json__(self, request):
         return {
             'id': self.id,
@@ -101,14 +309,88 @@ class StatusUpdate(Base):
         }
 
 
+class ArchivedBody(Base):
+    """Raw email of a status update, moved out of status_updates once old
+    enough that only the parsed reply is still read"""
+    __tablename__ = 'archived_bodies'
+
+    update_id = Column(Integer,
+                       ForeignKey('status_updates.id', ondelete='CASCADE'),
+                       primary_key=True)
+    raw_text = Column(CompressedText, nullable=True)
+    raw_html = Column(CompressedText, nullable=True)
+    archived = Column(DateTime(timezone=True), nullable=False, default=now)
+
+    @classmethod
+    def archive_before(cls, cutoff, batch_size):
+        """Move the raw bodies of up to batch_size updates older than cutoff
+        into the archive, compressed bytes as they are. Only updates with
+        a reply_text are moved. Returns how many were."""
+        updates = StatusUpdate.__table__
+        q = Session.query(StatusUpdate.id)
+        q = q.filter(StatusUpdate.when < cutoff)
+        q = q.filter(StatusUpdate.raw_text != None)  # noqa
+        q = q.filter(StatusUpdate.reply_text != None)  # noqa
+        ids = [update_id for (update_id,) in q.limit(batch_size)]
+        if not ids:
+            return 0
+        moved = select([updates.c.id, updates.c.raw_text, updates.c.raw_html,
+                        func.now()]).where(updates.c.id.in_(ids))
+        Session.execute(cls.__table__.insert().from_select(
+            ['update_id', 'raw_text', 'raw_html', 'archived'], moved
+        ))
+        Session.execute(updates.update().where(updates.c.id.in_(ids)).values(
+            raw_text=None, raw_html=None
+        ))
+        return len(ids)
+
+
+@event.listens_for(StatusUpdate, 'before_insert')
+@event.listens_for(StatusUpdate, 'before_update')
+def _set_week_bucket(mapper, connection, update):
+    if update.when is None:
+        update.when = now()
+    update.week = week_bucket(update.when)
+
+
+@event.listens_for(StatusUpdate, 'before_insert')
+def _set_search_vector(mapper, connection, update):
+    update.search_vector = StatusUpdate.search_vector_of(update.text)
+
+
+@event.listens_for(StatusUpdate, 'before_update')
+def _update_search_vector(mapper, connection, update):
+    if inspect(update).attrs.reply_text.history.has_changes():
+        _set_search_vector(mapper, connection, update)
+
+
+class Team(Base):
+    """Users of a team get their own summary and reminder runs"""
+    __tablename__ = 'teams'
+
+    name = Column(Text, primary_key=True)
+
+    users = relation('User', backref='team')
+
+    def __repr__(self):
+        cls_name = self.__class__.__name__
+        return "<{}('{}')>".format(cls_name, self.name)
+
+    @classmethod
+    def all_names(cls):
+        return [name for (name,) in Session.query(cls.name).order_by(cls.name)]
+
+
 class User(Base):
     __tablename__ = 'users'
 
     email_address = Column(Text, primary_key=True)
     full_name = Column(Text, default="")
-    timezone = Column(Text, nullable=False)
+    timezone = Column(Text, nullable=False, index=True)
     notifications_on = Column(Boolean, nullable=False, default=True)
     last_notified = Column(DateTime(timezone=True))
+    team_name = Column(Text, ForeignKey('teams.name'), nullable=True,
+                       index=True)
 
     status_updates = relation(StatusUpdate, backref='user')
 
@@ -116,26 +398,84 @@ class User(Base):
         cls_name = self.__class__.__name__
         return "<{}('{}')>".format(cls_name, self.email_address)
 
+    def __json__(self, request):
+        return {
+            'email': self.email_address,
+            'full_name': self.full_name,
+            'timezone': self.timezone,
+            'notifications_on': self.notifications_on,
+            'team': self.team_name,
+        }
+
     @classmethod
     def all_users(cls):
         all_users = Session.query(cls)
         return all_users
 
     @classmethod
-    def woke_users(cls):
+    def woke_users(cls, team=None):
         woke_users = Session.query(cls)
         woke_users = woke_users.filter(cls.notifications_on)
+        if team is not None:
+            woke_users = woke_users.filter(cls.team_name == team)
         return woke_users
 
     @classmethod
-    def to_notify(cls, when=None, force=False):
+    def to_notify(cls, when=None, force=False, timezones=None, team=None):
         if when is None:
             when = now()
 
-        all_users = Session.query(cls)
-        for user in all_users:
-            if force or user.should_be_notified(when):
-                yield user
+        if force:
+            q = Session.query(cls)
+            if timezones is not None:
+                q = q.filter(cls.timezone.in_(timezones))
+            if team is not None:
+                q = q.filter(cls.team_name == team)
+            return q
+        return cls.due_for_notification(when, timezones, team)
+
+    @classmethod
+    def timezones_in_use(cls, team=None):
+        """Timezones of users with notifications on"""
+        q = Session.query(cls.timezone).filter(cls.notifications_on)
+        if team is not None:
+            q = q.filter(cls.team_name == team)
+        return [zone for (zone,) in q.distinct()]
+
+    @classmethod
+    def due_for_notification(cls, when, timezones=None, team=None):
+        """Query for every user that should_be_notified at when, optionally
+        only those in timezones and/or team.
+
+        Users are evaluated per timezone: the local time, the "after
+        Friday 15:00" decision and the week are worked out once for each
+        zone in use, leaving the database to check last_notified and look
+        up an update for that week.
+        """
+        if timezones is None:
+            zones = cls.timezones_in_use(team)
+        else:
+            zones = timezones
+
+        q = Session.query(cls)
+        if team is not None:
+            q = q.filter(cls.team_name == team)
+        cohorts = [
+            and_(cls.timezone.in_(zones_for_week), not_(exists().where(and_(
+                StatusUpdate.email_address == cls.email_address,
+                StatusUpdate.week == week,
+            ))))
+            for week, zones_for_week in weeks_due(zones, when).items()
+        ]
+        if not cohorts:
+            return q.filter(false())
+        q = q.filter(cls.notifications_on)
+        q = q.filter(or_(*cohorts))
+        q = q.filter(or_(
+            cls.last_notified == None,  # noqa
+            cls.last_notified < when - NOTIFICATION_INTERVAL,
+        ))
+        return q
 
     def should_be_notified(self, when):
         if self.notifications_on:
@@ -143,7 +483,7 @@ class User(Base):
             if self.is_after_expected_update_time(when):
                 log.debug("last_notified: %r", self.last_notified)
                 if self.last_notified is None or (when - self.last_notified >
-                                                  timedelta(hours=24)):
+                                                  NOTIFICATION_INTERVAL):
                     if self.update_for_week(when).count() == 0:
                         return True
 
@@ -156,70 +496,214 @@ class User(Base):
 
     def is_after_expected_update_time(self, when):
         localtime = self.in_localtime(when)
-        day = localtime.isoweekday()
-        hour = localtime.hour
         log.debug("Local time for %r is %s", self, localtime)
-        if day == FRIDAY and hour >= 15:
-            return True
-        elif day > FRIDAY:
-            return True
-        else:
-            return False
+        return is_after_expected_update_time(localtime)
 
     def in_localtime(self, when):
         assert isinstance(when, datetime)
-        tz = pytz.timezone(self.timezone)
+        tz = get_timezone(self.timezone)
         localtime = when.astimezone(tz)
         return localtime
 
 
-class WeeklySummary(object):
+class OutboundEmail(Base):
+    """An email waiting to be sent by the outbox worker (drain_outbox)"""
+    __tablename__ = 'outbound_emails'
 
-    SUMMARY_TEMPLATE = Template("""Hi folks,
+    MAX_ATTEMPTS = 5
+    # Wait before the second attempt, doubled after each failure
+    RETRY_DELAY = timedelta(minutes=1)
 
-I've collected status updates from Week ${week} of ${year}!
+    id = Column(Integer, primary_key=True)
+    sender = Column(Text, nullable=False)
+    recipients = Column(Text, nullable=False)
+    subject = Column(Text, nullable=False)
+    body = Column(Text, nullable=False)
+    extra_headers = Column(Text, nullable=True)
+    created = Column(DateTime(timezone=True), nullable=False, default=now)
+    sent = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    next_attempt = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index('ix_outbound_emails_unsent', id, postgresql_where=(sent == None)),  # noqa
+    )
 
-%for user, updates in updates_by_user.items():
-${user.full_name} <${user.email_address}>:
+    def __repr__(self):
+        cls_name = self.__class__.__name__
+        return "<{}({!r}, {!r})>".format(cls_name, self.id, self.subject)
 
-  %for update in updates:
-${update.text}
-  %endfor
+    @classmethod
+    def from_message(cls, message):
+        outbound = cls(**cls.values_for(message))
+        Session.add(outbound)
+        return outbound
+
+    @staticmethod
+    def values_for(message):
+        """Column values queuing message, e.g. for a bulk insert"""
+        return {
+            'sender': message.sender,
+            'recipients': json.dumps(list(message.recipients)),
+            'subject': message.subject,
+            'body': message.body,
+            'extra_headers': (json.dumps(message.extra_headers)
+                              if message.extra_headers else None),
+        }
 
+    @classmethod
+    def pending(cls, limit, when=None):
+        """Oldest unsent emails due to be tried by when (default now),
+        locked until the transaction ends"""
+        q = Session.query(cls)
+        q = q.filter(cls.sent == None)  # noqa
+        q = q.filter(cls.attempts < cls.MAX_ATTEMPTS)
+        q = q.filter(or_(cls.next_attempt == None,  # noqa
+                         cls.next_attempt <= (when or now())))
+        q = q.order_by(cls.id).limit(limit)
+        q = q.with_for_update()
+        return q
 
-%endfor
+    def to_message(self):
+        from pyramid_mailer.message import Message
+        headers = json.loads(self.extra_headers or '{}')
+        return Message(subject=self.subject,
+                       sender=self.sender,
+                       recipients=json.loads(self.recipients),
+                       body=self.body,
+                       extra_headers=headers)
 
-%if len(users_without_updates) > 0:
-Sadly I didn't get updates from ${len(users_without_updates)} people:
-%for user in users_without_updates:
-${user.full_name} <${user.email_address}>
-%endfor
-%endif
+    def delivered(self, when=None):
+        self.attempts += 1
+        self.sent = when or now()
+        self.last_error = None
 
-See you next Friday!
-Friendly Robot
-""")
+    def failed(self, error, when=None):
+        self.attempts += 1
+        self.last_error = str(error)
+        self.next_attempt = ((when or now()) +
+                             self.RETRY_DELAY * 2 ** (self.attempts - 1))
 
-    def __init__(self, when=None):
-        self.when = when
-        self.updates = StatusUpdate.updates_in_week(when)
 
-        woke_users = {user for user in User.woke_users()}
+class WeeklySummary(object):
+
+    # Rows fetched per round trip while streaming a week's updates
+    BATCH_SIZE = 500
 
-        self.users_with_updates = {update.user for update in self.updates}
-        self.users_without_updates = woke_users - self.users_with_updates
+    def __init__(self, when=None, team=None):
+        self.when = when
+        self.team = team
+        self.updates = StatusUpdate.updates_in_week(when, team)
+
+        # Users with updates and woke users without, in one query. Rendering
+        # streams the updates in a second, their authors are then already
+        # in the session.
+        in_week = StatusUpdate.week == week_of(when)
+        woke = User.notifications_on
+        if team is not None:
+            in_week = and_(in_week, StatusUpdate.team_name == team)
+            woke = and_(woke, User.team_name == team)
+        has_updates = User.status_updates.any(in_week)
+        q = Session.query(User, has_updates).filter(or_(has_updates, woke))
+        self.users_with_updates = set()
+        self.users_without_updates = set()
+        for user, with_updates in q:
+            if with_updates:
+                self.users_with_updates.add(user)
+            else:
+                self.users_without_updates.add(user)
+
+    def iter_updates_by_user(self):
+        """Yield (user, updates) for each user, one user's updates in
+        memory at a time. Only the parsed reply text is loaded."""
+        q = self.updates.order_by(None)
+        q = q.order_by(StatusUpdate.email_address, StatusUpdate.when)
+        q = q.options(joinedload(StatusUpdate.user),
+                      defer(StatusUpdate.raw_text),
+                      defer(StatusUpdate.raw_html))
+        q = q.yield_per(self.BATCH_SIZE)
+        for email_address, updates in groupby(
+                q, key=attrgetter('email_address')):
+            updates = list(updates)
+            yield updates[0].user, updates
 
     def updates_by_user(self):
-        results = defaultdict(list)
-        for update in self.updates:
-            results[update.user].append(update)
-        return results
+        return OrderedDict(self.iter_updates_by_user())
 
-    def email_contents(self):
+    def iter_email_contents(self):
+        """Yield the summary email in chunks, one per user"""
         for_year, for_week, week_day = self.when.isocalendar()
-        return self.SUMMARY_TEMPLATE.render(**{
-            'week': for_week,
-            'year': for_year,
-            'updates_by_user': self.updates_by_user(),
-            'users_without_updates': self.users_without_updates,
-        })
+        yield render('summary_header.mako', self.team,
+                     week=for_week, year=for_year)
+        for user, updates in self.iter_updates_by_user():
+            yield render('summary_user_updates.mako', self.team,
+                         user=user, updates=updates)
+        without_updates = sorted(self.users_without_updates,
+                                 key=attrgetter('email_address'))
+        yield render('summary_footer.mako', self.team,
+                     users_without_updates=without_updates)
+
+    def email_contents(self):
+        return "".join(self.iter_email_contents())
+
+
+class SummarySnapshot(Base):
+    """Rendered WeeklySummary of a week that has closed"""
+    __tablename__ = 'summary_snapshots'
+
+    key = Column(Text, primary_key=True)
+    week = Column(Integer, nullable=False, index=True)
+    users_with_updates = Column(Text, nullable=False)
+    users_without_updates = Column(Text, nullable=False)
+    contents = Column(Text, nullable=False)
+    created = Column(DateTime(timezone=True), nullable=False, default=now)
+
+    def __repr__(self):
+        cls_name = self.__class__.__name__
+        return "<{}('{}')>".format(cls_name, self.key)
+
+    @staticmethod
+    def key_for(when, team=None):
+        if team is None:
+            return str(week_of(when))
+        return "{}/{}".format(team, week_of(when))
+
+    @classmethod
+    def for_week(cls, when, team=None):
+        """Snapshot of the summary for the week when is in, of everyone or
+        of team, rendering and storing it if needed. None while the week
+        can still change."""
+        if now() <= week_closes(when):
+            return None
+        snapshot = Session.query(cls).get(cls.key_for(when, team))
+        if snapshot is None:
+            snapshot = cls.from_summary(WeeklySummary(when, team))
+        return snapshot
+
+    @classmethod
+    def from_summary(cls, summary):
+        snapshot = cls()
+        snapshot.key = cls.key_for(summary.when, summary.team)
+        snapshot.week = week_of(summary.when)
+        snapshot.users_with_updates = json.dumps(sorted(
+            user.email_address for user in summary.users_with_updates
+        ))
+        snapshot.users_without_updates = json.dumps(sorted(
+            user.email_address for user in summary.users_without_updates
+        ))
+        snapshot.contents = summary.email_contents()
+        Session.add(snapshot)
+        return snapshot
+
+    @classmethod
+    def invalidate(cls, week):
+        """Drop snapshots of week, e.g. after a late update arrives"""
+        q = Session.query(cls).filter(cls.week == week)
+        q.delete(synchronize_session=False)
+
+    def addresses_with_updates(self):
+        return json.loads(self.users_with_updates)
+
+    def addresses_without_updates(self):
+        return json.loads(self.users_without_updates)
@@ -0,0 +1,133 @@
+"""Stripping quoted text and signatures from email replies
+
+strip_reply gives the same reply as email_reply_parser's
+EmailReplyParser.read(text).reply, without its cost on long threads.
+email_reply_parser searches for wrapped "On <date>, <someone> wrote:"
+headers with a regular expression that is quadratic in the length of the
+email, then splits the whole thread into lines and matches each of them
+against several expressions.
+
+Here the wrapped header is found with two string searches. A quote header
+(Gmail and Apple Mail's "On ... wrote:", Outlook's From:/Sent:/To:/Subject:
+block) hides everything below it, so the text above the topmost one is
+all that is split into fragments. The exception is an "On ... wrote:" that
+is followed by quoted text and then more unquoted text (an inline or
+bottom posted reply), where the whole email is still read.
+
+The parser used by parse_reply is picked with the replies.parser setting,
+'email_reply_parser' (the default) or 'builtin'.
+"""
+
+import re
+
+# email_reply_parser's QUOTE_HDR_REGEX (the "quote" group) and HEADER_REGEX
+HEADER = re.compile(
+    r'^(?:(?P<quote>On.*wrote:$)|\*?(?:From|Sent|To|Subject):\*? .+)',
+    re.MULTILINE,
+)
+QUOTE_HEADER_START = re.compile(r'On\s')
+WROTE = 'wrote:'
+# Neither blank nor an "On ... wrote:"
+OTHER_LINE = re.compile(r'^(?!On.*wrote:$)[^\n]*\S', re.MULTILINE)
+UNQUOTED_LINE = re.compile(r'^(?!>)[^\n]*\S', re.MULTILINE)
+SIGNATURE = re.compile(r'(--|__|-\w)|(^Sent from my (\w+\s*){1,3})')
+# Outlook puts its separator line right below the reply
+OUTLOOK_SEPARATOR = re.compile('([^\n])(?=\n ?[_-]{7,})')
+
+DEFAULT_PARSER = 'email_reply_parser'
+
+
+def strip_reply(text):
+    """The reply in an email body, without quoted text and signatures"""
+    text = _join_wrapped_header(text.replace('\r\n', '\n'))
+    header = HEADER.search(text)
+    if header is not None and _hides_below(text, header):
+        text = text[:max(header.start() - 1, 0)]
+    # Only adds blank lines, so can wait until the text is cut. Also,
+    # email_reply_parser passes re.MULTILINE as the count.
+    text = OUTLOOK_SEPARATOR.sub('\\1\n', text, re.MULTILINE)
+    fragments = []
+    found_visible = False
+    lines = quoted = headers = signature = None
+    for line in reversed(text.split('\n')):
+        blank = not line.strip()
+        match = HEADER.match(line)
+        is_quote_header = match is not None and match.group('quote')
+        is_quoted = line.startswith('>')
+        if lines and blank and SIGNATURE.match(lines[-1].strip()):
+            signature = True
+        elif lines and ((headers == (match is not None) and
+                         quoted == is_quoted) or
+                        (quoted and (is_quote_header or blank))):
+            lines.append(line)
+            continue
+        if lines:
+            found_visible = _finish(fragments, lines, quoted, headers,
+                                    signature, found_visible)
+        lines, quoted, headers, signature = ([line], is_quoted,
+                                             match is not None, False)
+    _finish(fragments, lines, quoted, headers, signature, found_visible)
+    return '\n'.join(content for content, visible in reversed(fragments)
+                     if visible)
+
+
+def _join_wrapped_header(text):
+    """Put the last "On ... wrote:" in text on one line, as
+    email_reply_parser does"""
+    wrote = text.rfind(WROTE)
+    if wrote < 0:
+        return text
+    start = None
+    # At least one character between "On " and "wrote:"
+    for start in QUOTE_HEADER_START.finditer(text, 0, wrote - 1):
+        pass
+    if start is None:
+        return text
+    start = start.start()
+    end = text.find(WROTE, start + 4) + len(WROTE)
+    return text[:start] + text[start:end].replace('\n', '') + text[end:]
+
+
+def _hides_below(text, header):
+    """Whether email_reply_parser would hide everything below header, or
+    at least show nothing from there"""
+    if not header.group('quote'):
+        return True
+    # "On ... wrote:" lines followed by quoted text are part of that quote
+    below = OTHER_LINE.search(text, header.end() + 1)
+    if below is None or not below.group().startswith('>'):
+        return True
+    return UNQUOTED_LINE.search(text, below.end()) is None
+
+
+def _finish(fragments, lines, quoted, headers, signature, found_visible):
+    content = '\n'.join(reversed(lines)).strip()
+    if headers:
+        found_visible = False
+        fragments[:] = [(below, False) for below, _ in fragments]
+    hidden = not found_visible and (quoted or headers or signature or
+                                    not content)
+    fragments.append((content, not (hidden or quoted)))
+    return found_visible or not hidden
+
+
+def email_reply_parser_reply(text):
+    from email_reply_parser import EmailReplyParser
+    return EmailReplyParser.read(text).reply
+
+
+PARSERS = {
+    'builtin': strip_reply,
+    'email_reply_parser': email_reply_parser_reply,
+}
+
+parser = PARSERS[DEFAULT_PARSER]
+
+
+def configure(settings):
+    """Pick the parser named by the replies.parser setting"""
+    global parser
+    name = settings.get('replies.parser', DEFAULT_PARSER)
+    if name not in PARSERS:
+        raise ValueError("Unknown replies.parser: {}".format(name))
+    parser = PARSERS[name]
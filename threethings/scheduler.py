@@ -0,0 +1,152 @@
+"""Long running reminder scheduler"""
+import heapq
+import time
+
+import pytz
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+from .model import (
+    EXPECTED_UPDATE_HOUR,
+    FRIDAY,
+    get_timezone,
+    is_after_expected_update_time,
+    now,
+    week_of,
+)
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_RECHECK = timedelta(hours=1)
+DEFAULT_REFRESH = timedelta(minutes=1)
+DEFAULT_RETRY = timedelta(minutes=5)
+
+
+def next_deadline(zone, after):
+    """First Friday 15:00 in zone strictly after after, in UTC"""
+    tz = get_timezone(zone)
+    localtime = after.astimezone(tz)
+    day = localtime.date() + timedelta(
+        days=(FRIDAY - localtime.isoweekday()) % 7
+    )
+    while True:
+        deadline = tz.localize(datetime(day.year, day.month, day.day,
+                                        EXPECTED_UPDATE_HOUR))
+        if deadline > after:
+            return deadline.astimezone(pytz.UTC)
+        day += timedelta(days=7)
+
+
+def next_due(zone, after, recheck=DEFAULT_RECHECK):
+    """Next instant users in zone may need a reminder.
+
+    Between the Friday deadline and the end of the local week users who
+    still haven't sent an update may be due at any time (they were added,
+    unmuted or their last reminder is 24 hours old), so the zone is checked
+    again every recheck. Otherwise it is due at the next deadline.
+    """
+    tz = get_timezone(zone)
+    localtime = after.astimezone(tz)
+    if is_after_expected_update_time(localtime):
+        candidate = after + recheck
+        if week_of(candidate.astimezone(tz)) == week_of(localtime):
+            return candidate
+    return next_deadline(zone, after)
+
+
+class ReminderScheduler(object):
+    """Keeps a heap of (next due instant, timezone), sleeping until the
+    earliest one and sending reminders only to that zone's users.
+
+    load_zones() returns the timezones currently in use, it is called
+    every refresh so zones of new or unmuted users are picked up.
+    notify(zones, when) sends the reminders due in zones and returns
+    lines of output.
+
+    If either fails, the error is logged and recover() called (e.g. to
+    reset the database session). Zones that failed to be notified are due
+    again after retry.
+    """
+
+    def __init__(self, load_zones, notify,
+                 recheck=DEFAULT_RECHECK,
+                 refresh=DEFAULT_REFRESH,
+                 retry=DEFAULT_RETRY,
+                 recover=lambda: None,
+                 clock=now,
+                 sleep=time.sleep):
+        self.load_zones = load_zones
+        self.notify = notify
+        self.recheck = recheck
+        self.refresh = refresh
+        self.retry = retry
+        self.recover = recover
+        self.clock = clock
+        self.sleep = sleep
+        self.heap = []
+        # zone -> due instant of its live heap entry, others are stale
+        self.scheduled = {}
+
+    def schedule(self, zone, due):
+        self.scheduled[zone] = due
+        heapq.heappush(self.heap, (due, zone))
+
+    def refresh_zones(self, when):
+        zones = set(self.load_zones())
+        for zone in zones - set(self.scheduled):
+            log.debug("Scheduling new timezone %s", zone)
+            if is_after_expected_update_time(
+                    when.astimezone(get_timezone(zone))):
+                self.schedule(zone, when)
+            else:
+                self.schedule(zone, next_deadline(zone, when))
+        for zone in set(self.scheduled) - zones:
+            log.debug("Timezone %s no longer in use", zone)
+            del self.scheduled[zone]
+
+    def pop_due(self, when):
+        due_zones = []
+        while self.heap and self.heap[0][0] <= when:
+            due, zone = heapq.heappop(self.heap)
+            if self.scheduled.get(zone) == due:
+                del self.scheduled[zone]
+                due_zones.append(zone)
+        return due_zones
+
+    def run(self):
+        """Run forever, yielding the output of each notify"""
+        next_refresh = self.clock()
+        while True:
+            current = self.clock()
+            if current >= next_refresh:
+                try:
+                    self.refresh_zones(current)
+                except Exception:
+                    log.exception("Loading timezones failed")
+                    self.recover()
+                next_refresh = current + self.refresh
+            due_zones = self.pop_due(current)
+            if due_zones:
+                try:
+                    for line in self.notify(due_zones, current):
+                        yield line
+                except Exception:
+                    log.exception("Reminding %s failed, retrying in %s",
+                                  ", ".join(due_zones), self.retry)
+                    self.recover()
+                    for zone in due_zones:
+                        self.schedule(zone, current + self.retry)
+                else:
+                    for zone in due_zones:
+                        self.schedule(zone,
+                                      next_due(zone, current, self.recheck))
+            wake = next_refresh
+            if self.heap:
+                wake = min(wake, self.heap[0][0])
+            delay = (wake - self.clock()).total_seconds()
+            if delay > 0:
+                self.sleep(delay)
@@ -4,6 +4,7 @@ ENVIRON_SETTINGS_MAP = {
     'DATABASE_URL': 'database.url',
     'SMTP_USER': 'mail.username',
     'SMTP_PASSWORD': 'mail.password',
+    'API_TOKEN': 'api.token',
 }
 
 
@@ -0,0 +1,241 @@
+"""Write-behind spool of inbound email
+
+A Spool is a file of JSON lines. Appending one is a single write and fsync,
+so a webhook can accept an email as soon as it is on disk, and a
+SpoolFlusher thread stores what has accumulated in batches, every few
+seconds or as soon as a batch is full.
+
+To flush, the spool file is renamed aside (path + '.flushing') and a new one
+started, so appends never wait on the database. How far into it has been
+stored is recorded after each batch (path + '.flushed'), and the file is
+removed once all of it is. One left behind by a crash or a failed flush is
+resumed first next time. A crash between storing a batch and recording it
+stores that batch again, so storing must be idempotent (e.g. by
+Message-Id).
+
+A batch that keeps failing is stored a record at a time, and records that
+still fail are moved to a dead letter spool (path + '.dead') rather than
+holding up everything after them. It can be flushed like any other spool
+once the problem is fixed. Processes may share a spool, appends and renames
+are serialised with flock().
+"""
+import errno
+import fcntl
+import json
+import os
+import threading
+
+from contextlib import (
+    contextmanager,
+)
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_BATCH_SIZE = 500
+# Failed attempts at a batch before its records are tried one by one
+DEFAULT_MAX_ATTEMPTS = 5
+
+
+class Spool(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.flushing_path = path + '.flushing'
+        self.flushed_path = path + '.flushed'
+        self.dead_path = path + '.dead'
+        # flock() doesn't exclude threads of the same process
+        self._locks = {'.lock': threading.Lock(),
+                       '.flush-lock': threading.Lock()}
+
+    def append(self, record):
+        """Durably add record (anything json.dumps takes)"""
+        with self._locked('.lock'):
+            _append(self.path, record)
+
+    def dead_letter(self, record):
+        Spool(self.dead_path).append(record)
+
+    def claim(self):
+        """Rename the spool aside for flushing, unless an earlier one is
+        still there. The path claimed, or None when there is nothing."""
+        with self._locked('.lock'):
+            if os.path.exists(self.flushing_path):
+                return self.flushing_path
+            try:
+                os.rename(self.path, self.flushing_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None
+        return self.flushing_path
+
+    def batches(self, path, batch_size):
+        """(records, offset after them) of a claimed spool file, in lists of
+        batch_size from where flushing it last got to. A torn last line,
+        from a crash while appending, is skipped."""
+        offset = self._flushed()
+        batch = []
+        with open(path, 'rb') as spool:
+            spool.seek(offset)
+            for line in iter(spool.readline, b''):
+                offset += len(line)
+                try:
+                    batch.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    log.error("Skipping unreadable line ending at %d of %s",
+                              offset, path)
+                if len(batch) >= batch_size:
+                    yield batch, offset
+                    batch = []
+        if batch:
+            yield batch, offset
+
+    def flushed(self, offset):
+        """Record that the claimed file is stored up to offset"""
+        with open(self.flushed_path + '.new', 'w') as flushed:
+            flushed.write(str(offset))
+            flushed.flush()
+            os.fsync(flushed.fileno())
+        os.rename(self.flushed_path + '.new', self.flushed_path)
+
+    def _flushed(self):
+        try:
+            with open(self.flushed_path) as flushed:
+                return int(flushed.read())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def release(self, path):
+        # Progress first, a new claim must never resume at its offset
+        if os.path.exists(self.flushed_path):
+            os.remove(self.flushed_path)
+        os.remove(path)
+
+    @contextmanager
+    def flushing(self):
+        """Hold the flush lock, yielding False instead if another process
+        is flushing"""
+        with self._locked('.flush-lock', blocking=False) as locked:
+            yield locked
+
+    @contextmanager
+    def _locked(self, suffix, blocking=True):
+        lock = self._locks[suffix]
+        if not lock.acquire(blocking):
+            yield False
+            return
+        try:
+            with open(self.path + suffix, 'a') as lock_file:
+                flags = fcntl.LOCK_EX
+                if not blocking:
+                    flags |= fcntl.LOCK_NB
+                try:
+                    fcntl.flock(lock_file, flags)
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock.release()
+
+
+def _append(path, record):
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with open(path, 'ab') as spool:
+        spool.write(line.encode('utf-8'))
+        spool.flush()
+        os.fsync(spool.fileno())
+
+
+class SpoolFlusher(threading.Thread):
+    """Background thread passing the records of spool to store(records),
+    at most batch_size at a time, every interval seconds or when woken.
+    Exceptions in transient (e.g. the database being down) are retried
+    for as long as they last, others max_attempts times."""
+
+    def __init__(self, spool, store, interval=DEFAULT_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, transient=()):
+        super(SpoolFlusher, self).__init__(name='spool-flusher')
+        self.daemon = True
+        self.spool = spool
+        self.store = store
+        self.interval = interval
+        self.batch_size = max(1, int(batch_size))
+        self.max_attempts = max(1, int(max_attempts))
+        self.transient = tuple(transient)
+        self.failures = 0
+        self.pending = 0
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def append(self, record):
+        self.spool.append(record)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self._wake.set()
+
+    def run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Flushing %s failed, will retry",
+                              self.spool.path)
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def flush(self):
+        """Store everything spooled so far, returning how many records
+        were passed to store"""
+        stored = 0
+        with self.spool.flushing() as locked:
+            if not locked:
+                return stored
+            self.pending = 0
+            while True:
+                path = self.spool.claim()
+                if path is None:
+                    return stored
+                for batch, offset in self.spool.batches(path,
+                                                        self.batch_size):
+                    self._store(batch)
+                    self.spool.flushed(offset)
+                    stored += len(batch)
+                self.spool.release(path)
+
+    def _store(self, batch):
+        try:
+            self.store(batch)
+        except self.transient:
+            raise
+        except Exception:
+            self.failures += 1
+            if self.failures < self.max_attempts:
+                raise
+            log.exception("Storing a batch from %s failed %d times, "
+                          "storing it one record at a time",
+                          self.spool.path, self.failures)
+            for record in batch:
+                try:
+                    self.store([record])
+                except self.transient:
+                    raise
+                except Exception:
+                    log.exception("Moving a record to %s",
+                                  self.spool.dead_path)
+                    self.spool.dead_letter(record)
+        self.failures = 0
@@ -0,0 +1,5 @@
+
+Thanks! I've got it.
+
+Cheers,
+Friendly Robot
@@ -0,0 +1,8 @@
+
+Hi,
+
+Please reply with your weekly status update! Three simple things that
+you did last week, and three things you're planning on doing next week.
+
+Cheers,
+Friendly Robot
@@ -0,0 +1,10 @@
+
+%if len(users_without_updates) > 0:
+Sadly I didn't get updates from ${len(users_without_updates)} people:
+%for user in users_without_updates:
+${user.full_name} <${user.email_address}>
+%endfor
+%endif
+
+See you next Friday!
+Friendly Robot
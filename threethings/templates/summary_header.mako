@@ -0,0 +1,4 @@
+Hi folks,
+
+I've collected status updates from Week ${week} of ${year}!
+
@@ -0,0 +1,7 @@
+${user.full_name} <${user.email_address}>:
+
+  %for update in updates:
+${update.text}
+  %endfor
+
+
@@ -0,0 +1,90 @@
+"""Mako templates of outbound email
+
+Templates are looked up by name in, first to last:
+
+* ``teams/<team>/`` in each of the directories below, when rendering for
+  a team
+* each of the ``templates.directories`` setting (whitespace separated)
+* threethings/templates, the templates shipped
+
+so a deployment, or a single team, can override any template by adding a
+file of the same name. With the ``templates.module_directory`` setting,
+compiled templates are kept as modules in that directory so short lived
+processes don't compile them again. A module is recompiled when its
+template file is newer. Without it, or when the directory can't be
+written to, templates are compiled in memory.
+"""
+
+import errno
+import os
+
+from mako.lookup import (
+    TemplateLookup,
+)
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(__file__), 'templates')
+
+directories = []
+module_directory = None
+
+_lookups = {}
+
+
+def configure(settings):
+    """Set the template directories and module cache from settings"""
+    global directories, module_directory
+    directories = [os.path.expanduser(directory) for directory in
+                   settings.get('templates.directories', '').split()]
+    module_directory = settings.get('templates.module_directory')
+    if module_directory:
+        module_directory = _writable(os.path.expanduser(module_directory))
+    else:
+        module_directory = None
+    _lookups.clear()
+
+
+def _writable(directory):
+    """directory, created if need be, or None if it can't be written to"""
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            log.warning("Compiling templates in memory, can't create %s: %s",
+                        directory, e)
+            return None
+    if not os.access(directory, os.W_OK):
+        log.warning("Compiling templates in memory, can't write to %s",
+                    directory)
+        return None
+    return directory
+
+
+def lookup(team=None):
+    """The TemplateLookup for team, or everyone when None"""
+    if team not in _lookups:
+        search = directories + [DEFAULT_DIRECTORY]
+        if team is not None:
+            search = [os.path.join(directory, 'teams', team)
+                      for directory in search] + search
+        if module_directory is not None:
+            _lookups[team] = TemplateLookup(
+                directories=search, module_directory=module_directory,
+                modulename_callable=_module_filename,
+            )
+        else:
+            _lookups[team] = TemplateLookup(directories=search)
+    return _lookups[team]
+
+
+def _module_filename(filename, uri):
+    """Compiled modules are named after their template file rather than
+    the name looked up, which resolves to different files for each team"""
+    return os.path.join(module_directory,
+                        os.path.abspath(filename).lstrip(os.sep)) + '.py'
+
+
+def render(name, team=None, **context):
+    return lookup(team).get_template(name).render(**context)
@@ -8,6 +8,14 @@ from ..model import (
     Base,
 )
 
+from ..metrics import (
+    instrument_engine,
+)
+from .. import (
+    replies,
+    templating,
+)
+
 from ..settings_utils import(
     load_settings_from_environ,
     ENVIRON_SETTINGS_MAP,
@@ -18,8 +26,10 @@ def main(global_config, **settings):
     """This functions returns a Pyramid WSGI application"""
 
     load_settings_from_environ(settings, ENVIRON_SETTINGS_MAP)
+    replies.configure(settings)
+    templating.configure(settings)
 
-    engine = engine_from_config(settings, 'database.')
+    engine = instrument_engine(engine_from_config(settings, 'database.'))
     Session.configure(bind=engine)
     Base.metadata.bind = engine
 
@@ -28,4 +38,7 @@ def main(global_config, **settings):
     config.include('pyramid_mailer')
     # config.include('.mandrill', route_prefix="/mandrill")
     config.include('.mailgun', route_prefix="/mailgun")
+    config.include('.search', route_prefix="/search")
+    config.include('.api', route_prefix="/api")
+    config.include('.metrics')
     return config.make_wsgi_app()
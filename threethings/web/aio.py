@@ -0,0 +1,328 @@
+"""Asyncio server for the Mailgun webhook
+
+An alternative to serving the Pyramid app with waitress for inbound mail.
+POST /mailgun/receive gives the same responses as mailgun.receive_email,
+but uploads are read as they arrive, updates are stored through a pool of
+asyncpg connections and confirmations are sent with aiosmtplib, so one
+process can keep thousands of slow connections open.
+
+Needs Python 3.5+ and the 'aio' extra (aiohttp, asyncpg, aiosmtplib):
+
+    python -m threethings.web.aio configs/heroku.ini
+
+As with the Pyramid app, a confirmation is queued in the outbox in the
+same transaction as its update. It is then sent straight away by a
+background task, drain_outbox retries any that fail.
+"""
+import asyncio
+import os
+import sys
+import urllib.parse
+
+import aiosmtplib
+import asyncpg
+
+from aiohttp import (
+    web,
+)
+from pyramid.settings import (
+    asbool,
+)
+from repoze.lru import (
+    LRUCache,
+)
+
+from ..delivery import (
+    DEFAULT_WORKERS,
+)
+from ..email_processing import (
+    confirm_message,
+)
+from ..model import (
+    CompressedText,
+    OutboundEmail,
+    User,
+    SEARCH_CONFIG,
+    parse_reply,
+    week_bucket,
+)
+from .. import (
+    replies,
+    templating,
+)
+from ..settings_utils import (
+    load_settings_from_environ,
+    ENVIRON_SETTINGS_MAP,
+)
+from .mailgun import (
+    DEFAULT_MAX_BODY_SIZE,
+    DEFAULT_SEEN_MESSAGE_IDS,
+    EVENT_FIELDS,
+    email_fields,
+    message_id_of,
+)
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+# Connections waiting to be accepted, aiohttp's default of 128 drops bursts
+DEFAULT_BACKLOG = 1024
+
+# What StatusUpdate.from_email and queue_confirm write
+INSERT_UPDATE = """
+INSERT INTO status_updates (email_address, raw_text, raw_html, reply_text,
+                            "when", week, team_name, message_id,
+                            search_vector, received)
+VALUES ($1, $2, $3, $4, $5, $6,
+        (SELECT team_name FROM users WHERE email_address = $1),
+        $7, to_tsvector($8::regconfig, coalesce($4, '')), now())
+RETURNING id, email_address, "when"
+"""
+INVALIDATE_SNAPSHOTS = "DELETE FROM summary_snapshots WHERE week = $1"
+SELECT_USER = "SELECT * FROM users WHERE email_address = $1"
+INSERT_OUTBOUND = """
+INSERT INTO outbound_emails (sender, recipients, subject, body,
+                             extra_headers, created, attempts)
+VALUES ($1, $2, $3, $4, $5, now(), 0)
+RETURNING id
+"""
+SELECT_DELIVERED = """
+SELECT id, email_address, "when" FROM status_updates WHERE message_id = $1
+"""
+# Skipped if drain_outbox is already sending it
+LOCK_OUTBOUND = """
+SELECT id FROM outbound_emails WHERE id = $1 AND sent IS NULL
+FOR UPDATE SKIP LOCKED
+"""
+OUTBOUND_DELIVERED = """
+UPDATE outbound_emails SET attempts = attempts + 1, sent = now(),
+                           last_error = NULL
+WHERE id = $1
+"""
+OUTBOUND_FAILED = """
+UPDATE outbound_emails
+SET attempts = attempts + 1, last_error = $2,
+    next_attempt = now() + $3::interval * power(2, attempts)
+WHERE id = $1
+"""
+
+
+class InboundReceiver(object):
+    """Stores inbound email and sends confirmations, as
+    mailgun.process_inbound_email does in the Pyramid app"""
+
+    def __init__(self, pool, smtp, seen_message_ids=DEFAULT_SEEN_MESSAGE_IDS,
+                 smtp_workers=DEFAULT_WORKERS):
+        self.pool = pool
+        self.smtp = smtp
+        # Message-Id -> JSON of the update, of emails stored by this process
+        self.seen = LRUCache(seen_message_ids)
+        self.smtp_slots = asyncio.Semaphore(smtp_workers)
+        self.compressed = CompressedText()
+        self._sending = set()
+
+    @classmethod
+    async def from_settings(cls, settings):
+        """Connect to database.url with a pool of aio.pool_size
+        connections, sending mail with the settings pyramid_mailer reads"""
+        database_url = settings['database.url']
+        dsn = 'postgresql://' + database_url.split('://', 1)[1]
+        pool = await asyncpg.create_pool(
+            dsn, min_size=1,
+            max_size=int(settings.get('aio.pool_size', DEFAULT_POOL_SIZE)),
+        )
+        smtp = {
+            'hostname': settings.get('mail.host', 'localhost'),
+            'port': int(settings.get('mail.port', 25)),
+            'username': settings.get('mail.username'),
+            'password': settings.get('mail.password'),
+            'start_tls': asbool(settings.get('mail.tls', False)),
+            'use_tls': asbool(settings.get('mail.ssl', False)),
+            'timeout': float(settings.get('mail.timeout', 30)),
+        }
+        return cls(pool, smtp,
+                   seen_message_ids=int(settings.get(
+                       'mailgun.seen_message_ids', DEFAULT_SEEN_MESSAGE_IDS
+                   )),
+                   smtp_workers=int(settings.get('mail.pool_size',
+                                                 DEFAULT_WORKERS)))
+
+    async def close(self):
+        """Wait for confirmations being sent, then disconnect"""
+        if self._sending:
+            await asyncio.wait(self._sending)
+        await self.pool.close()
+
+    async def process_inbound_email(self, email_json):
+        """The JSON of the update stored for the email, or of the one
+        already stored when it is a repeat delivery. None when the sender
+        is unknown and the email dropped."""
+        email = email_fields(email_json)
+        message_id = email['message_id']
+        if message_id is not None:
+            delivered = await self._delivered(message_id)
+            if delivered is not None:
+                log.info("Ignoring repeat delivery of %s", message_id)
+                return delivered
+        async with self.pool.acquire() as connection:
+            try:
+                async with connection.transaction():
+                    stored = await self._store(connection, email)
+            except asyncpg.UniqueViolationError:
+                # Possibly a concurrent delivery of the email stored first
+                delivered = None
+                if message_id is not None:
+                    delivered = await connection.fetchrow(SELECT_DELIVERED,
+                                                          message_id)
+                if delivered is None:
+                    raise
+                return _update_json(delivered)
+        if stored is None:
+            return None
+        update, outbound_id, message = stored
+        if message_id is not None:
+            self.seen.put(message_id, update)
+        sending = asyncio.ensure_future(self._send(outbound_id, message))
+        self._sending.add(sending)
+        sending.add_done_callback(self._sending.discard)
+        return update
+
+    async def _delivered(self, message_id):
+        cached = self.seen.get(message_id)
+        if cached is not None:
+            return cached
+        async with self.pool.acquire() as connection:
+            row = await connection.fetchrow(SELECT_DELIVERED, message_id)
+        if row is None:
+            return None
+        update = _update_json(row)
+        self.seen.put(message_id, update)
+        return update
+
+    async def _store(self, connection, email):
+        user = await connection.fetchrow(SELECT_USER, email['author'])
+        if user is None:
+            log.warning("Dropping update from unknown sender %s",
+                        email['author'])
+            return None
+        reply_text = parse_reply(email['text'])
+        week = week_bucket(email['when'])
+        row = await connection.fetchrow(
+            INSERT_UPDATE, email['author'],
+            self.compressed.process_bind_param(email['text'], None),
+            self.compressed.process_bind_param(email['html'], None),
+            reply_text, email['when'], week, email['message_id'],
+            SEARCH_CONFIG,
+        )
+        await connection.execute(INVALIDATE_SNAPSHOTS, week)
+        message = confirm_message(User(**dict(user)),
+                                  reply_to_id=email['message_id'],
+                                  reply_to_subject=email['subject'])
+        values = OutboundEmail.values_for(message)
+        outbound_id = await connection.fetchval(
+            INSERT_OUTBOUND, values['sender'], values['recipients'],
+            values['subject'], values['body'], values['extra_headers'],
+        )
+        return _update_json(row), outbound_id, message
+
+    async def _send(self, outbound_id, message):
+        async with self.smtp_slots, self.pool.acquire() as connection:
+            async with connection.transaction():
+                if await connection.fetchval(LOCK_OUTBOUND,
+                                             outbound_id) is None:
+                    return
+                try:
+                    await aiosmtplib.send(message.to_message(), **self.smtp)
+                except (aiosmtplib.SMTPException, OSError) as e:
+                    log.warning("Confirmation %d failed, left for "
+                                "drain_outbox: %s", outbound_id, e)
+                    await connection.execute(OUTBOUND_FAILED, outbound_id,
+                                             str(e),
+                                             OutboundEmail.RETRY_DELAY)
+                else:
+                    await connection.execute(OUTBOUND_DELIVERED,
+                                             outbound_id)
+
+
+def _update_json(row):
+    """StatusUpdate.__json__ of a row"""
+    return {
+        'id': row['id'],
+        'email': row['email_address'],
+        'when': row['when'].isoformat(),
+    }
+
+
+async def webhook_allowed(request):
+    return web.Response(status=200)
+
+
+async def receive_email(request):
+    max_body_size = request.app['max_body_size']
+    if request.content_length is None:
+        raise web.HTTPLengthRequired()
+    if request.content_length > max_body_size:
+        # Mailgun retries anything else but a 200, for hours
+        raise web.HTTPNotAcceptable(text="Email too large")
+    mailgun_event = await parse_mailgun_event(request)
+    update = await request.app['receiver'].process_inbound_email(
+        mailgun_event
+    )
+    # As the Pyramid app, unknown senders get a 200 and no update
+    return web.json_response([update] if update is not None else [])
+
+
+async def parse_mailgun_event(request):
+    """As mailgun.parse_mailgun_event, parts not in EVENT_FIELDS are read
+    past as they arrive without being kept"""
+    event = {}
+    if request.content_type == 'multipart/form-data':
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name in EVENT_FIELDS:
+                event.setdefault(part.name, []).append(await part.text())
+            else:
+                await part.release()
+    else:
+        body = (await request.read()).decode('utf-8')
+        for name, value in urllib.parse.parse_qsl(body,
+                                                  keep_blank_values=True):
+            if name in EVENT_FIELDS:
+                event.setdefault(name, []).append(value)
+    event['parsed_message_id'] = message_id_of(event['message-headers'][0])
+    return event
+
+
+def make_app(settings):
+    max_body_size = int(settings.get('mailgun.max_body_size',
+                                     DEFAULT_MAX_BODY_SIZE))
+    app = web.Application(client_max_size=max_body_size)
+    app['max_body_size'] = max_body_size
+
+    async def receiver(app):
+        app['receiver'] = await InboundReceiver.from_settings(settings)
+        yield
+        await app['receiver'].close()
+
+    app.cleanup_ctx.append(receiver)
+    app.router.add_route('HEAD', '/mailgun/receive', webhook_allowed)
+    app.router.add_route('POST', '/mailgun/receive', receive_email)
+    return app
+
+
+def main(argv=None):
+    from pyramid.paster import get_appsettings, setup_logging
+    argv = sys.argv[1:] if argv is None else argv
+    config_uri = argv[0] if argv else 'configs/heroku.ini'
+    setup_logging(config_uri)
+    settings = dict(get_appsettings(config_uri))
+    load_settings_from_environ(settings, ENVIRON_SETTINGS_MAP)
+    replies.configure(settings)
+    templating.configure(settings)
+    web.run_app(make_app(settings), port=int(os.environ.get('PORT', 5000)),
+                backlog=int(settings.get('aio.backlog', DEFAULT_BACKLOG)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
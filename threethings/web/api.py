@@ -0,0 +1,225 @@
+"""Read only JSON API over status updates and users
+
+Lists come in pages of at most ?limit= items in a stable order, a page's
+"next" is passed back as ?after= for the page following it (null on the
+last page). Every list has an ETag that changes when rows are added,
+changed or deleted, so clients polling with If-None-Match get a 304
+without the page being read. Lists of updates also give a Last-Modified,
+but as a delete doesn't move it, it is never used to answer a 304.
+
+The API, search (threethings.web.search) and /metrics are public unless
+api.token is set (or API_TOKEN in the environment), then requests must send
+it as "Authorization: Bearer <token>".
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+
+import iso8601
+
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPNotModified,
+    HTTPUnauthorized,
+)
+from sqlalchemy import (
+    func,
+    cast,
+    tuple_,
+    Text,
+)
+from sqlalchemy.dialects.postgresql import (
+    aggregate_order_by,
+)
+from sqlalchemy.orm import (
+    defer,
+)
+
+from ..model import (
+    Session,
+    StatusUpdate,
+    User,
+)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+def includeme(config):
+    config.add_route('api_updates', '/updates')
+    config.add_route('api_week_updates', '/weeks/{week}/updates')
+    config.add_route('api_users', '/users')
+    config.add_route('api_user_updates', '/users/{email_address}/updates')
+    for route_name, view in [('api_updates', updates_in_range),
+                             ('api_week_updates', updates_in_week),
+                             ('api_users', list_users),
+                             ('api_user_updates', updates_by_user)]:
+        config.add_view(view, route_name=route_name, decorator=token_required,
+                        request_method='GET', renderer='json')
+
+
+def token_required(view):
+    """Check the bearer token against the api.token setting, if any"""
+
+    def checked_view(context, request):
+        token = (request.registry.settings or {}).get('api.token')
+        if token:
+            sent = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(sent.encode('utf-8'),
+                                       ('Bearer ' + token).encode('utf-8')):
+                raise HTTPUnauthorized(headers=[('WWW-Authenticate',
+                                                 'Bearer')])
+        return view(context, request)
+    return checked_view
+
+
+def updates_in_range(request):
+    """Updates sent from ?since= up to ?until= (ISO 8601, UTC unless
+    given), either may be left out"""
+    criteria = []
+    if 'since' in request.params:
+        criteria.append(StatusUpdate.when >= _date_param(request, 'since'))
+    if 'until' in request.params:
+        criteria.append(StatusUpdate.when < _date_param(request, 'until'))
+    return _updates_page(request, criteria)
+
+
+def updates_in_week(request):
+    """Updates counting towards a week, given as year * 100 + isoweek"""
+    try:
+        week = int(request.matchdict['week'])
+    except ValueError:
+        raise HTTPNotFound()
+    return _updates_page(request, [StatusUpdate.week == week])
+
+
+def updates_by_user(request):
+    email_address = request.matchdict['email_address']
+    if Session.query(User).get(email_address) is None:
+        raise HTTPNotFound()
+    return _updates_page(request,
+                         [StatusUpdate.email_address == email_address])
+
+
+def list_users(request):
+    limit = _limit(request)
+    after = _after(request)
+
+    row = func.concat_ws(',', User.email_address, User.full_name,
+                         User.timezone, cast(User.notifications_on, Text),
+                         User.team_name)
+    q = Session.query(func.md5(func.string_agg(
+        row, aggregate_order_by('\n', User.email_address)
+    )))
+    not_modified = _conditional(request, [q.scalar()])
+    if not_modified is not None:
+        return not_modified
+
+    q = Session.query(User).order_by(User.email_address)
+    if after is not None:
+        q = q.filter(User.email_address > after)
+    users = q.limit(limit + 1).all()
+    return {
+        'users': [user.__json__(request) for user in users[:limit]],
+        'next': (_cursor(users[limit - 1].email_address)
+                 if len(users) > limit else None),
+    }
+
+
+def _updates_page(request, criteria):
+    limit = _limit(request)
+    after = _after(request)
+
+    # Hashing the rows catches updates rewritten in place, e.g. by
+    # backfill_reply_text, which count and max(id) would miss
+    row = func.concat_ws(',', StatusUpdate.id, StatusUpdate.email_address,
+                         StatusUpdate.when, StatusUpdate.reply_text)
+    q = Session.query(func.count(StatusUpdate.id),
+                      func.max(StatusUpdate.id),
+                      func.md5(func.string_agg(
+                          row, aggregate_order_by('\n', StatusUpdate.id)
+                      )),
+                      func.max(func.coalesce(StatusUpdate.received,
+                                             StatusUpdate.when)))
+    count, last_id, digest, last_modified = q.filter(*criteria).one()
+    not_modified = _conditional(request, [count, last_id, digest],
+                                last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    q = Session.query(StatusUpdate)
+    q = q.options(defer(StatusUpdate.raw_text),
+                  defer(StatusUpdate.raw_html),
+                  defer(StatusUpdate.search_vector))
+    q = q.filter(*criteria)
+    if after is not None:
+        try:
+            when, update_id = iso8601.parse_date(after[0]), int(after[1])
+        except (iso8601.ParseError, TypeError, ValueError, IndexError):
+            raise HTTPBadRequest("Bad after")
+        q = q.filter(tuple_(StatusUpdate.when, StatusUpdate.id) >
+                     tuple_(when, update_id))
+    q = q.order_by(StatusUpdate.when, StatusUpdate.id)
+    updates = q.limit(limit + 1).all()
+    if len(updates) > limit:
+        last = updates[limit - 1]
+        next_page = _cursor([last.when.isoformat(), last.id])
+    else:
+        next_page = None
+    return {
+        'updates': [update.__json__(request) for update in updates[:limit]],
+        'next': next_page,
+    }
+
+
+def _conditional(request, validators, last_modified=None):
+    """Set the ETag (of validators and the query string) and Last-Modified
+    of the response. A 304 response if the client sent a matching ETag,
+    else None."""
+    validators = [request.query_string] + [str(v) for v in validators]
+    etag = hashlib.sha1(json.dumps(validators).encode('utf-8')).hexdigest()
+    response = request.response
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if 'If-None-Match' in request.headers and etag in request.if_none_match:
+        return HTTPNotModified(headers=[
+            (name, value) for name, value in response.headerlist
+            if name in ('ETag', 'Last-Modified')
+        ])
+    return None
+
+
+def _limit(request):
+    try:
+        limit = int(request.params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise HTTPBadRequest("limit must be a number")
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def _date_param(request, name):
+    try:
+        return iso8601.parse_date(request.params[name])
+    except iso8601.ParseError:
+        raise HTTPBadRequest("{} must be an ISO 8601 date".format(name))
+
+
+def _cursor(position):
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode('utf-8')
+    ).decode('ascii')
+
+
+def _after(request):
+    if 'after' not in request.params:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(
+            request.params['after'].encode('ascii')
+        ).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise HTTPBadRequest("Bad after")
@@ -3,6 +3,7 @@
 import json
 import datetime
 import pytz
+import transaction
 
 from pyramid.view import (
     view_config,
@@ -10,21 +11,82 @@ from pyramid.view import (
 from pyramid.response import (
     Response,
 )
-from pyramid_mailer import get_mailer
+from pyramid.httpexceptions import (
+    HTTPLengthRequired,
+    HTTPNotAcceptable,
+)
+from repoze.lru import (
+    LRUCache,
+)
+from sqlalchemy.exc import (
+    IntegrityError,
+    OperationalError,
+)
+from zope.sqlalchemy import (
+    mark_changed,
+)
 from ..model import (
+    Session,
     StatusUpdate,
+    User,
 )
 from ..email_processing import (
-    send_confirm,
+    queue_confirm,
+)
+from ..spool import (
+    Spool,
+    SpoolFlusher,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_INTERVAL,
 )
 
 import logging
 log = logging.getLogger(__name__)
 
 
+DEFAULT_SEEN_MESSAGE_IDS = 10000
+# Mailgun's own limit on the size of a message
+DEFAULT_MAX_BODY_SIZE = 25 * 1024 * 1024
+
+# The only fields of a Mailgun event read, everything else (body-html,
+# stripped-*, attachment-N...) is left unparsed
+EVENT_FIELDS = (
+    'event',
+    'timestamp',
+    'sender',
+    'subject',
+    'body-plain',
+    'message-headers',
+)
+
+
 def includeme(config):
+    settings = config.get_settings()
+    config.registry.max_body_size = int(settings.get(
+        'mailgun.max_body_size', DEFAULT_MAX_BODY_SIZE
+    ))
+    # Message-Id -> JSON of the update, of emails committed by this process
+    config.registry.seen_message_ids = LRUCache(int(settings.get(
+        'mailgun.seen_message_ids', DEFAULT_SEEN_MESSAGE_IDS
+    )))
+    # With mailgun.spool set, emails are appended to that file and stored
+    # in batches by a background thread. The database being unreachable
+    # holds up flushing, other errors move failing emails aside.
+    config.registry.inbound_spool = None
+    if settings.get('mailgun.spool'):
+        flusher = SpoolFlusher(
+            Spool(settings['mailgun.spool']), store_spooled_emails,
+            interval=float(settings.get('mailgun.spool_interval',
+                                        DEFAULT_INTERVAL)),
+            batch_size=int(settings.get('mailgun.spool_batch_size',
+                                        DEFAULT_BATCH_SIZE)),
+            transient=(OperationalError,),
+        )
+        flusher.start()
+        config.registry.inbound_spool = flusher
     config.add_route('mailgun_receiving', '/receive')
-    config.scan()
+    # aio needs the optional aio extra, and has no views anyway
+    config.scan(ignore='.aio')
 
 
 @view_config(route_name='mailgun_receiving', request_method='HEAD')
@@ -36,35 +98,110 @@ def webhook_allowed(request):
              request_method='POST',
              renderer='json')
 def receive_email(request):
+    if request.content_length is None:
+        return HTTPLengthRequired()
+    if request.content_length > request.registry.max_body_size:
+        # Mailgun retries anything else but a 200, for hours
+        return HTTPNotAcceptable("Email too large")
     mailgun_events = parse_mailgun_event(request)
-    mailer = get_mailer(request)
-    updates = process_inbound_email(mailer, mailgun_events)
+    # Only Message-Id makes storing a spooled email again harmless
+    if (request.registry.inbound_spool is not None and
+            mailgun_events['parsed_message_id'] is not None):
+        return spool_inbound_email(mailgun_events,
+                                   request.registry.inbound_spool)
+    updates = process_inbound_email(mailgun_events,
+                                    request.registry.seen_message_ids)
 
     return list(updates)
 
 
 def parse_mailgun_event(request):
     """
-        Mailgun returns a WebOb NestedMultiDict pile of goo.
-        Take each key/value and crate a corresponding key/value
+        Take the values of each of EVENT_FIELDS out of the POSTed form,
+        as lists like WebOb's dict_of_lists() would.
         Get Message-Id out of message-headers for use later.
+
+        WebOb spools uploaded parts (attachments) to temporary files
+        rather than keeping them in memory, and only the fields wanted are
+        copied out of request.POST.
     """
-    parsed_mailgun_event = request.params.dict_of_lists()
-    email_headers = {}
-    mailgun_header = json.loads(
-        request.params.getall('message-headers')[0]
+    form = request.POST
+    parsed_mailgun_event = {}
+    for field in EVENT_FIELDS:
+        if field in form:
+            parsed_mailgun_event[field] = [
+                _text(value) for value in form.getall(field)
+            ]
+    parsed_mailgun_event["parsed_message_id"] = message_id_of(
+        parsed_mailgun_event['message-headers'][0]
     )
+
+    return parsed_mailgun_event
+
+
+def message_id_of(message_headers):
+    """The Message-Id in Mailgun's message-headers JSON, or None"""
+    email_headers = {}
+    mailgun_header = json.loads(message_headers)
     # iterate to parse out message_id
     for i in mailgun_header:
         email_headers[i[0]] = i[1]
-    parsed_mailgun_event["parsed_message_id"] = email_headers.get(
-        'Message-Id'
-    )
+    return email_headers.get('Message-Id')
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
 
-    return parsed_mailgun_event
+
+def process_inbound_email(email_json, seen=None):
+    """Store the update and queue its confirmation in the outbox. Emails
+    with a Message-Id already stored (Mailgun retries) are not stored or
+    confirmed again, the existing update is returned instead. seen is an
+    optional LRUCache of recently stored Message-Ids, checked first.
+    Emails from unknown senders are dropped, yielding nothing, as
+    store_spooled_emails does."""
+    email = email_fields(email_json)
+    author, timestamp = email['author'], email['when']
+    text, html = email['text'], email['html']
+    subject, message_id = email['subject'], email['message_id']
+    if message_id is not None:
+        delivered = _delivered(message_id, seen)
+        if delivered is not None:
+            log.info("Ignoring repeat delivery of %s", message_id)
+            yield delivered
+            return
+    # An error would only have Mailgun retry it for hours
+    if Session.query(User).get(author) is None:
+        log.warning("Dropping update from unknown sender %s", author)
+        return
+    if message_id is None:
+        update = StatusUpdate.from_email(author, timestamp, text, html)
+    else:
+        savepoint = transaction.savepoint()
+        try:
+            update = StatusUpdate.from_email(author, timestamp, text, html,
+                                             message_id=message_id)
+        except IntegrityError:
+            # Possibly a concurrent delivery of the email committed first
+            savepoint.rollback()
+            delivered = StatusUpdate.for_message_id(message_id)
+            if delivered is None:
+                raise
+            yield delivered
+            return
+    queue_confirm(update.user,
+                  reply_to_id=message_id,
+                  reply_to_subject=subject,
+                  )
+    if seen is not None and message_id is not None:
+        _remember_after_commit(seen, message_id, update.__json__(None))
+    yield update
 
 
-def process_inbound_email(mailer, email_json):
+def email_fields(email_json):
+    """from_email's arguments, and the subject, of a Mailgun event"""
     # mailgun delivers a response, we don't need to process.
     # response conains the key 'event' while incoming msg
     # does not.
@@ -72,18 +209,75 @@ def process_inbound_email(mailer, email_json):
         raise ValueError(
             'Unexpected event: {}'.format(email_json['event'])
         )
-    timestamp = datetime.datetime.fromtimestamp(
-        float(email_json['timestamp'][0]), tz=pytz.UTC
-    )
-    author = email_json['sender'][0]
-    text = email_json['body-plain'][0]
-    html = email_json['body-html'][0]
-    subject = email_json['subject'][0]
-    message_id = email_json["parsed_message_id"]
-    update = StatusUpdate.from_email(author, timestamp, text, html)
-    send_confirm(mailer,
-                 update.user,
-                 reply_to_id=message_id,
-                 reply_to_subject=subject,
-                 )
-    yield update
+    return {
+        'author': email_json['sender'][0],
+        'when': datetime.datetime.fromtimestamp(
+            float(email_json['timestamp'][0]), tz=pytz.UTC
+        ),
+        'text': email_json['body-plain'][0],
+        'html': email_json.get('body-html', [None])[0],
+        'subject': email_json['subject'][0],
+        'message_id': email_json["parsed_message_id"],
+    }
+
+
+def spool_inbound_email(email_json, flusher):
+    """Append the email to the flusher's spool, to be stored by
+    store_spooled_emails shortly. Only for emails with a Message-Id."""
+    email = email_fields(email_json)
+    if email['message_id'] is None:
+        raise ValueError("Only emails with a Message-Id can be spooled")
+    flusher.append(email_json)
+    return [{
+        'email': email['author'],
+        'when': email['when'].isoformat(),
+        'message_id': email['message_id'],
+        'spooled': True,
+    }]
+
+
+def store_spooled_emails(email_jsons):
+    """Store a batch of spooled emails with one INSERT and queue
+    confirmations of those not stored before, in one transaction"""
+    emails = [email_fields(email_json) for email_json in email_jsons]
+    subjects = dict(((email['author'], email['message_id'], email['when']),
+                     email['subject']) for email in emails)
+    with transaction.manager:
+        stored = StatusUpdate.insert_many(emails)
+        q = Session.query(User)
+        q = q.filter(User.email_address.in_(
+            set(row.email_address for row in stored)
+        ))
+        users = dict((user.email_address, user) for user in q)
+        for row in stored:
+            queue_confirm(users[row.email_address],
+                          reply_to_id=row.message_id,
+                          reply_to_subject=subjects[(row.email_address,
+                                                     row.message_id,
+                                                     row.when)],
+                          )
+        mark_changed(Session())
+        transaction.commit()
+    log.info("Stored %d of %d spooled emails", len(stored), len(emails))
+    return len(stored)
+
+
+def _delivered(message_id, seen):
+    """The update (or its JSON, when cached) stored for message_id"""
+    if seen is not None:
+        cached = seen.get(message_id)
+        if cached is not None:
+            return cached
+    update = StatusUpdate.for_message_id(message_id)
+    if update is not None and seen is not None:
+        seen.put(message_id, update.__json__(None))
+    return update
+
+
+def _remember_after_commit(seen, message_id, update_json):
+    """Cache the update only once it is stored, an aborted request must not
+    make its retry look like a repeat"""
+    def remember(committed):
+        if committed:
+            seen.put(message_id, update_json)
+    transaction.get().addAfterCommitHook(remember)
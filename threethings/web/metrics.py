@@ -0,0 +1,44 @@
+"""Request instrumentation and a Prometheus scrape endpoint"""
+
+from pyramid.events import (
+    ContextFound,
+)
+from pyramid.response import (
+    Response,
+)
+
+from .. import metrics
+from .api import (
+    token_required,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def includeme(config):
+    config.add_route('metrics', '/metrics')
+    config.add_view(scrape_metrics, route_name='metrics',
+                    decorator=token_required, request_method='GET')
+    config.add_subscriber(name_request_scope, ContextFound)
+    config.add_tween('threethings.web.metrics.metrics_tween_factory',
+                     over='pyramid_tm.tm_tween_factory')
+
+
+def scrape_metrics(request):
+    return Response(metrics.registry.render(), content_type=CONTENT_TYPE,
+                    charset='utf-8')
+
+
+def name_request_scope(event):
+    """Label the request's statements with its route once it is known"""
+    route = event.request.matched_route
+    metrics.set_scope(route.name if route is not None else 'no_route')
+
+
+def metrics_tween_factory(handler, registry):
+
+    def metrics_tween(request):
+        with metrics.scope('request'):
+            return handler(request)
+
+    return metrics_tween
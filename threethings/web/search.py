@@ -0,0 +1,65 @@
+"""JSON search over status updates"""
+
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+)
+
+from ..model import (
+    StatusUpdate,
+)
+from .api import (
+    token_required,
+)
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+
+def includeme(config):
+    config.add_route('search_updates', '/updates')
+    config.add_view(search_updates, route_name='search_updates',
+                    decorator=token_required, request_method='GET',
+                    renderer='json')
+
+
+def search_updates(request):
+    """Updates matching ?q=, best first, ?per_page= at a time. ?page=
+    starts at 1, next_page is null on the last page."""
+    terms = request.params.get('q', '').strip()
+    if not terms:
+        raise HTTPBadRequest("Missing q")
+    try:
+        page = max(int(request.params.get('page', 1)), 1)
+        per_page = min(max(int(request.params.get(
+            'per_page', DEFAULT_PER_PAGE)), 1), MAX_PER_PAGE)
+    except ValueError:
+        raise HTTPBadRequest("page and per_page must be numbers")
+    team = request.params.get('team')
+
+    q = StatusUpdate.search(terms, team)
+    # One more than asked for tells whether there is a next page
+    matches = q.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return {
+        'q': terms,
+        'page': page,
+        'per_page': per_page,
+        'next_page': page + 1 if len(matches) > per_page else None,
+        'results': [search_result(update, rank, request)
+                    for update, rank in matches[:per_page]],
+    }
+
+
+def search_result(update, rank, request):
+    result = update.__json__(request)
+    # Updates can outlive their author's user
+    if update.user is not None:
+        full_name = update.user.full_name
+    else:
+        full_name = update.email_address
+    result.update({
+        'full_name': full_name,
+        'week': update.week,
+        'rank': rank,
+        'text': update.text,
+    })
+    return result